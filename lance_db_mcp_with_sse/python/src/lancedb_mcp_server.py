@@ -3,18 +3,20 @@ import logging
 import os
 import sys
 from dataclasses import dataclass
-from typing import Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
 import anyio
 from langchain_community.vectorstores import LanceDB
+from litellm.types.llms.bedrock import ToolResultBlock, ToolResultContentBlock
 from mcp.server.fastmcp import FastMCP
+from pydantic import BaseModel, Field
 
 from config import defaults
 from lance_db_mcp_with_sse.python.src.lancedb.client import LanceDBClient
 from lance_db_mcp_with_sse.python.src.tools.tools import (
-    broad_search_tool,
-    catalog_search_tool,
-    chunk_search_tool,
+    DEFAULT_TOOL_USE_ID,
+    aexecute_multi_search_tool,
+    aexecute_search_tool,
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -26,12 +28,22 @@ MCP Server Initialization: The FastMCP class from the mcp.server.fastmcp module
 pip install git+https://github.com/modelcontextprotocol/python-sdk/archive/refs/tags/v1.3.0rc1.zip
 
 """
+class SearchQuery(BaseModel):
+    text: str = Field(..., description="Search string")
+    source: Optional[str] = Field(None, description="Only search chunks of this catalog source")
+
+
 @dataclass
 class LanceDBConfig:
     db_uri: str
     params: Dict[str, str]
     chunks_table: str = "chunks"
     catalog_table: str = "catalog"
+    # concurrent calls per tool; further calls wait, up to max_pending of them, and are then turned away
+    tool_concurrency: int = 8
+    max_pending: int = 64
+    # worker threads running LanceDB searches, shared by all tools
+    search_threads: int = 16
 
 class LanceDBFastMCP:
     def __init__(self, config: LanceDBConfig):
@@ -47,6 +59,8 @@ class LanceDBFastMCP:
         )
         self.chunks_vector_store: Optional[LanceDB] = None
         self.catalog_vector_store: Optional[LanceDB] = None
+        self.search_limiter = anyio.CapacityLimiter(config.search_threads)
+        self.tool_limiters: Dict[str, anyio.CapacityLimiter] = {}
 
         self.setup_database()
         self.register_tools()
@@ -65,21 +79,46 @@ class LanceDBFastMCP:
             logger.exception("Failed to connect to LanceDB")
             sys.exit(1)
 
+    async def run_tool(self, name: str, call: Callable[[], Awaitable[Any]]) -> str:
+        """
+        Run a tool call without blocking the server's event loop, so one slow embedding or search doesn't stall
+        the other clients. Calls beyond `tool_concurrency` wait; beyond `max_pending` waiting calls the tool
+        answers with an error right away instead of queueing without bound.
+        """
+        limiter = self.tool_limiters.setdefault(name, anyio.CapacityLimiter(self.config.tool_concurrency))
+        if limiter.statistics().tasks_waiting >= self.config.max_pending:
+            logger.warning(f"Rejecting {name} call, {self.config.max_pending} calls already waiting")
+            return json.dumps(ToolResultBlock(
+                toolUseId=DEFAULT_TOOL_USE_ID,
+                content=[ToolResultContentBlock(text="The server is busy, retry the search shortly.")],
+                status="error"
+            ))
+        async with limiter:
+            tool_response = await call()
+        return json.dumps(tool_response)
+
+    async def run_search_tool(self, name: str, vector_store: LanceDB, text: str, source: Optional[str] = None) -> str:
+        return await self.run_tool(name, lambda: aexecute_search_tool(vector_store, text, source_filter=source,
+                                                                      limiter=self.search_limiter))
+
     def register_tools(self) -> None:
         @self.mcp.tool(description="Search document chunks across all documents.")
-        def broad_search(text: str) -> str:
-            tool_response = broad_search_tool(self.chunks_vector_store, text)
-            return json.dumps(tool_response)
+        async def broad_search(text: str) -> str:
+            return await self.run_search_tool("broad_search", self.chunks_vector_store, text)
 
         @self.mcp.tool(description="Search documents in the catalog.")
-        def catalog_search(text: str) -> str:
-            tool_response = catalog_search_tool(self.catalog_vector_store, text)
-            return json.dumps(tool_response)
+        async def catalog_search(text: str) -> str:
+            return await self.run_search_tool("catalog_search", self.catalog_vector_store, text)
 
         @self.mcp.tool(description="Search chunks from a specific catalog source.")
-        def chunk_search(text: str, source: str) -> str:
-            tool_response = chunk_search_tool(self.chunks_vector_store, text, source)
-            return json.dumps(tool_response)
+        async def chunk_search(text: str, source: str) -> str:
+            return await self.run_search_tool("chunk_search", self.chunks_vector_store, text, source)
+
+        @self.mcp.tool(description="Search document chunks for several queries in one call, each optionally "
+                                   "limited to a catalog source. Returns one result block per query, in order.")
+        async def multi_search(queries: List[SearchQuery], k: Optional[int] = None) -> str:
+            return await self.run_tool("multi_search", lambda: aexecute_multi_search_tool(
+                self.chunks_vector_store, [query.model_dump() for query in queries], k, limiter=self.search_limiter))
 
     async def run_server(self) -> None:
         try:
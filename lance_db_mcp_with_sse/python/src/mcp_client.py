@@ -22,11 +22,18 @@ def flatten_schema(schema):
         ref_key = ref.split("/")[-1]  # Extract the reference key
         return definitions.get(ref_key, {})
 
+    def inline(value):
+        """Replaces every $ref, including nested ones like the items of a list of objects."""
+        if isinstance(value, dict):
+            if "$ref" in value:
+                return inline(resolve_ref(value["$ref"]))  # Replace $ref with actual definition
+            return {key: inline(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [inline(item) for item in value]
+        return value
+
     # Process properties and inline references
-    properties = schema["properties"]
-    for key, value in properties.items():
-        if isinstance(value, dict) and "$ref" in value:
-            properties[key] = resolve_ref(value["$ref"])  # Replace $ref with actual definition
+    schema["properties"] = inline(schema["properties"])
 
     return schema
 
@@ -65,20 +72,58 @@ def convert_tool_format(tools):
     return {"tools": converted_tools}
 
 
-async def main():
+# converted tool lists by server URL, so later sessions with the same server skip list_tools and the conversion
+_tools_lists = {}
+
+# tool calls of one model turn that run at the same time
+MAX_CONCURRENT_TOOL_CALLS = 4
+
+
+async def get_tools_list(session, server_url):
+    if server_url not in _tools_lists:
+        # List available tools and convert to serializable format
+        tools_result = await session.list_tools()
+        _tools_lists[server_url] = convert_tool_format(tools_result.tools)
+        logger.info("Available tools: %s", _tools_lists[server_url])
+    return _tools_lists[server_url]
+
+
+async def call_tool(session, tool, semaphore):
+    """Call a tool through the MCP session and return its Bedrock toolResult."""
+    logger.info("Requesting tool %s. Request: %s", tool['name'], tool['toolUseId'])
+    try:
+        async with semaphore:
+            tool_response = await session.call_tool(tool['name'], tool['input'])
+        tool_result = json.loads(tool_response.content[0].text.replace("default_tool_use_id", tool['toolUseId']))
+        if isinstance(tool_result, list):
+            # e.g. multi_search, one result block per query; Bedrock takes an object as json content
+            tool_result = {
+                "toolUseId": tool['toolUseId'],
+                "content": [{"json": {"results": tool_result}}],
+                "status": "success"
+            }
+        print(tool_result)
+    except Exception as err:
+        logger.error("Tool call failed: %s", str(err))
+        tool_result = {
+            "toolUseId": tool['toolUseId'],
+            "content": [{"text": f"Error: {str(err)}"}],
+            "status": "error"
+        }
+    return tool_result
+
+
+async def main(server_url="http://localhost:8000/sse"):
     # Initialize Bedrock client
     bedrock = boto3.client('bedrock-runtime')
 
-    async with sse_client("http://localhost:8000/sse") as streams:
+    async with sse_client(server_url) as streams:
         async with ClientSession(streams[0], streams[1]) as session:
             await session.initialize()
             # sleep a bit to allow the session to be initialized
             await asyncio.sleep(1)
 
-            # List available tools and convert to serializable format
-            tools_result = await session.list_tools()
-            tools_list = convert_tool_format(tools_result.tools)
-            logger.info("Available tools: %s", tools_list)
+            tools_list = await get_tools_list(session, server_url)
 
 
             # Prepare the request for Nova Pro model
@@ -107,8 +152,9 @@ and `chunk_search` return relevant results.
             ]
 
             while True:
-                # Call Bedrock with Nova Pro model
-                response = bedrock.converse(
+                # Call Bedrock with Nova Pro model, in a thread so the MCP session keeps being served
+                response = await asyncio.to_thread(
+                    bedrock.converse,
                     modelId='anthropic.claude-3-5-haiku-20241022-v1:0', #'us.amazon.nova-pro-v1:0',
                     messages=messages,
                     system=system,
@@ -130,34 +176,20 @@ and `chunk_search` return relevant results.
                         print("Model:", content['text'])
 
                 if stop_reason == 'tool_use':
-                    # Tool use requested. Call the tool and send the result to the model.
+                    # Tool use requested. Call the tools concurrently and send all results to the model.
                     tool_requests = response['output']['message']['content']
                     print(tool_requests)
-                    for tool_request in tool_requests:
-                        if 'toolUse' in tool_request:
-                            tool = tool_request['toolUse']
-                            logger.info("Requesting tool %s. Request: %s",
-                                        tool['name'], tool['toolUseId'])
-
-                            try:
-                                # Call the tool through the MCP session
-                                tool_response = await session.call_tool(tool['name'], tool['input'])
-                                tool_result = json.loads(tool_response.content[0].text.replace("default_tool_use_id", tool['toolUseId']))
-                                print(tool_result)
-
-                            except Exception as err:
-                                logger.error("Tool call failed: %s", str(err))
-                                tool_result = {
-                                    "toolUseId": tool['toolUseId'],
-                                    "content": [{"text": f"Error: {str(err)}"}],
-                                    "status": "error"
-                                }
-
-                            # Add tool result to messages
-                            messages.append({
-                                "role": "user",
-                                "content": [{"toolResult": tool_result}]
-                            })
+                    semaphore = asyncio.Semaphore(MAX_CONCURRENT_TOOL_CALLS)
+                    tool_results = await asyncio.gather(*(
+                        call_tool(session, tool_request['toolUse'], semaphore)
+                        for tool_request in tool_requests if 'toolUse' in tool_request
+                    ))
+
+                    # Bedrock expects the results of all tool uses of a turn in one user message
+                    messages.append({
+                        "role": "user",
+                        "content": [{"toolResult": tool_result} for tool_result in tool_results]
+                    })
                 else:
                     # No more tool use requests, we're done
                     break
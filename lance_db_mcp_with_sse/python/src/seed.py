@@ -1,6 +1,9 @@
 import argparse
 import asyncio
 import hashlib
+import threading
+import time
+import uuid
 
 from langchain.chains.summarize import load_summarize_chain
 from langchain.prompts import PromptTemplate
@@ -13,6 +16,9 @@ from langchain_ollama.llms import OllamaLLM
 
 import lancedb
 
+from lance_vector_database_on_s3.embedding_cache import CachedEmbeddings
+from lance_db_mcp_with_sse.python.src.tools.tools import normalize_source
+
 defaults = {
     "embedding_model": "snowflake-arctic-embed2",
     "catalog_table_name": "catalog",
@@ -32,6 +38,8 @@ def parse_arguments():
     parser.add_argument("--dbpath", required=True, help="Path to the LanceDB database.")
     parser.add_argument("--filesdir", required=True, help="Path to the directory containing documents.")
     parser.add_argument("--overwrite", action="store_true", help="Overwrite existing data.")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Documents summarized at the same time (match Ollama's OLLAMA_NUM_PARALLEL).")
     return parser.parse_args()
 
 
@@ -44,9 +52,43 @@ def validate_args(args):
     print("OVERWRITE FLAG:", args.overwrite)
 
 
-def compute_hash(file_path):
+def compute_hash(file_path, block_size=1024 * 1024):
+    sha256 = hashlib.sha256()
     with open(file_path, "rb") as f:
-        return hashlib.sha256(f.read()).hexdigest()
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class SummaryCache:
+    """
+    Content overviews by file hash and summarization model, kept in a table of the seeded database. Overviews are
+    written as soon as they're generated, so a re-seed after a crash, with --overwrite, or against the same
+    database from another machine only summarizes documents it hasn't seen.
+    """
+
+    def __init__(self, db, table_name="summary_cache"):
+        self.db = db
+        self.table_name = table_name
+        self.table = db.open_table(table_name) if table_name in db.table_names() else None
+        self.lock = threading.Lock()
+        self.summaries = {}
+        if self.table is not None:
+            for row in self.table.search().limit(None).to_list():
+                self.summaries[(row["hash"], row["model"])] = row["summary"]
+
+    def get(self, file_hash, model):
+        return self.summaries.get((file_hash, model))
+
+    def put(self, file_hash, model, summary):
+        row = {"hash": file_hash, "model": model, "summary": summary}
+        # called from several worker threads, the first two must not both create the table
+        with self.lock:
+            if self.table is None:
+                self.table = self.db.create_table(self.table_name, [row])
+            else:
+                self.table.add([row])
+            self.summaries[(file_hash, model)] = summary
 
 
 async def catalog_record_exists(catalog_table, file_hash):
@@ -73,7 +115,25 @@ async def generate_content_overview(raw_docs, model):
     return res["output_text"]
 
 
-async def process_documents(raw_docs, catalog_table, model, skip_exists_check):
+def write_chunks(db, docs, embeddings, table_name):
+    """
+    Write the chunks in the layout the LangChain LanceDB store reads (id, text, vector, metadata), plus a top level
+    `source` column with a bitmap index, so searches within one document can prefilter on it.
+    """
+    vectors = embeddings.embed_documents([doc.page_content for doc in docs])
+    rows = [{"id": str(uuid.uuid4()), "text": doc.page_content, "vector": vector, "metadata": doc.metadata,
+             "source": doc.metadata["source"]} for doc, vector in zip(docs, vectors)]
+    table = db.create_table(table_name, rows, mode="overwrite")
+    # few distinct values, so a bitmap rather than a btree index
+    table.create_scalar_index("source", index_type="BITMAP", replace=True)
+    return LanceDB(connection=db, embedding=embeddings, table_name=table_name)
+
+
+async def process_documents(raw_docs, catalog_table, model, skip_exists_check, workers=4, summary_cache=None):
+    """
+    Summarize the documents of every new source, `workers` at a time. Sources are hashed and checked against the
+    catalog ahead of the workers, through a queue of at most 2 * `workers` sources.
+    """
     docs_by_source = {}
     for doc in raw_docs:
         source = doc.metadata.get("source")
@@ -81,18 +141,46 @@ async def process_documents(raw_docs, catalog_table, model, skip_exists_check):
 
     skip_sources = []
     catalog_records = []
-
-    for source, docs in docs_by_source.items():
-        file_hash = compute_hash(source)
-        exists = not skip_exists_check and await catalog_record_exists(catalog_table, file_hash)
-        if exists:
-            print(f"Document with hash {file_hash} already exists in the catalog. Skipping...")
-            skip_sources.append(source)
-        else:
-            content_overview = await generate_content_overview(docs, model)
+    queue = asyncio.Queue(maxsize=2 * workers)
+    model_name = getattr(model, "model", type(model).__name__)
+    progress = {"done": 0, "cached": 0}
+    started = time.perf_counter()
+
+    def report(source):
+        progress["done"] += 1
+        elapsed = time.perf_counter() - started
+        print(f"[{progress['done']}/{len(docs_by_source)}] {source} "
+              f"({progress['done'] / elapsed * 60:.1f} documents/min, {progress['cached']} from the summary cache)")
+
+    async def produce():
+        for source, docs in docs_by_source.items():
+            file_hash = await asyncio.to_thread(compute_hash, source)
+            exists = not skip_exists_check and await catalog_record_exists(catalog_table, file_hash)
+            if exists:
+                print(f"Document with hash {file_hash} already exists in the catalog. Skipping...")
+                skip_sources.append(source)
+                report(source)
+            else:
+                await queue.put((source, docs, file_hash))
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def summarize():
+        while (item := await queue.get()) is not None:
+            source, docs, file_hash = item
+            content_overview = summary_cache.get(file_hash, model_name) if summary_cache else None
+            if content_overview is None:
+                content_overview = await generate_content_overview(docs, model)
+                if summary_cache:
+                    await asyncio.to_thread(summary_cache.put, file_hash, model_name, content_overview)
+            else:
+                progress["cached"] += 1
             print(f"Content overview for {source}: {content_overview}")
             catalog_records.append(
                 Document(page_content=content_overview, metadata={"source": source, "hash": file_hash}))
+            report(source)
+
+    await asyncio.gather(produce(), *(summarize() for _ in range(workers)))
 
     return skip_sources, catalog_records
 
@@ -103,6 +191,8 @@ async def seed(args=None):
 
     db = lancedb.connect(args.dbpath)
     model = OllamaLLM(model=summarization_model, base_url=base_url)
+    # re-seeding only embeds chunks and overviews that weren't embedded before
+    embeddings = CachedEmbeddings(OllamaEmbeddings(model=embedding_model, base_url=base_url))
 
     try:
         catalog_table = db.open_table(catalog_table_name)
@@ -128,16 +218,18 @@ async def seed(args=None):
     raw_docs = directory_loader.load()
 
     for doc in raw_docs:
-        doc.metadata = {"loc": doc.metadata.get("loc"), "source": doc.metadata.get("source")}
+        # normalized once here, so filters on the source compare exact values
+        doc.metadata = {"loc": doc.metadata.get("loc"), "source": normalize_source(doc.metadata.get("source"))}
 
     print("Processing documents...")
     skip_sources, catalog_records = await process_documents(raw_docs, catalog_table, model,
-                                                            args.overwrite or not catalog_table)
+                                                            args.overwrite or not catalog_table,
+                                                            workers=getattr(args, "workers", 4),
+                                                            summary_cache=SummaryCache(db))
 
-    catalog_store = (LanceDB.from_documents(catalog_records, OllamaEmbeddings(model=embedding_model, base_url=base_url),
-                                            uri=args.dbpath, table_name=catalog_table_name)
-                     if catalog_records else LanceDB(None, OllamaEmbeddings(model=embedding_model, base_url=base_url),
-                                                     uri=args.dbpath, table=catalog_table))
+    catalog_store = (LanceDB.from_documents(catalog_records, embeddings, uri=args.dbpath,
+                                            table_name=catalog_table_name)
+                     if catalog_records else LanceDB(None, embeddings, uri=args.dbpath, table=catalog_table))
 
     print("Number of new catalog records:", len(catalog_records))
     print("Number of skipped sources:", len(skip_sources))
@@ -149,12 +241,11 @@ async def seed(args=None):
     docs = splitter.split_documents(filtered_raw_docs) # change to filtered_raw_docs when doing catalog
 
     vector_store = (
-        LanceDB.from_documents(docs, OllamaEmbeddings(model=embedding_model, base_url=base_url), uri=args.dbpath,
-                               table_name=chunks_table_name)
-        if docs else LanceDB(None, OllamaEmbeddings(model=embedding_model, base_url=base_url), uri=args.dbpath,
-                             table=chunks_table))
+        write_chunks(db, docs, embeddings, chunks_table_name)
+        if docs else LanceDB(None, embeddings, uri=args.dbpath, table=chunks_table))
 
     print("Number of new chunks:", len(docs))
+    embeddings.cache.flush()
 
 
 # FOR WINDOWS ONLY
@@ -194,10 +285,11 @@ if __name__ == "__main__":
     ollama_process = start_ollama()
 
     class Args:
-        def __init__(self, dbpath, filesdir, overwrite):
+        def __init__(self, dbpath, filesdir, overwrite, workers=4):
             self.dbpath = dbpath
             self.filesdir = filesdir
             self.overwrite = overwrite
+            self.workers = workers
 
     asyncio.run(seed(args=Args(dbpath=temp_db_path, filesdir=temp_files_dir, overwrite=True)))
 
@@ -1,29 +1,83 @@
 import logging
+import posixpath
+from functools import partial
 from typing import List, Optional
 
+import anyio
 from langchain_community.vectorstores import LanceDB
 from litellm.types.llms.bedrock import ToolResultBlock, ToolResultContentBlock
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_TOOL_USE_ID = "default_tool_use_id"
+# results per query, the LangChain retriever default
+DEFAULT_K = 4
+
+def normalize_source(source: str) -> str:
+    """One spelling per path (forward slashes, no doubled separators), applied at seed time and to filters."""
+    return posixpath.normpath(source.replace('\\', '/'))
+
+
+def source_where(source: str) -> str:
+    """A filter on the indexed `source` column of the chunks table."""
+    return "source = '{}'".format(normalize_source(source).replace("'", "''"))
+
+
+def _search_kwargs(source_filter: Optional[str], k: Optional[int]) -> dict:
+    search_kwargs = {"k": k} if k else {}
+    if source_filter:
+        # prefiltering returns k chunks of the source rather than the source's share of the top k
+        search_kwargs.update(filter=source_where(source_filter), prefilter=True)
+    return search_kwargs
+
 
 def perform_retrieval(vector_store: LanceDB, text: str, source_filter: Optional[str] = None, k: Optional[int] = None) -> List[ToolResultContentBlock]:
-    retriever = vector_store.as_retriever(search_kwargs={"k": k} if k else {})
+    retriever = vector_store.as_retriever(search_kwargs=_search_kwargs(source_filter, k))
     results = retriever.invoke(text)
 
-    if source_filter:
-        normalized_filter = source_filter.replace('\\\\', '\\')
-        results = [
-            doc for doc in results
-            if doc.metadata["source"].replace('\\\\', '\\') == normalized_filter
-        ]
+    return [
+        ToolResultContentBlock(json={"source": doc.metadata["source"], "text": doc.page_content})
+        for doc in results
+    ]
+
+async def aperform_retrieval(vector_store: LanceDB, text: str, source_filter: Optional[str] = None, k: Optional[int] = None,
+                             limiter: Optional[anyio.CapacityLimiter] = None) -> List[ToolResultContentBlock]:
+    """
+    `perform_retrieval` without blocking the event loop: the query is embedded with the async embedding client and
+    the (blocking) LanceDB search runs in a worker thread, at most `limiter` of them at a time.
+    """
+    embedding = await vector_store.embeddings.aembed_query(text)
+    search = partial(vector_store.similarity_search_by_vector, embedding, **_search_kwargs(source_filter, k))
+    results = await anyio.to_thread.run_sync(search, limiter=limiter)
 
     return [
         ToolResultContentBlock(json={"source": doc.metadata["source"], "text": doc.page_content})
         for doc in results
     ]
 
+async def aexecute_search_tool(
+        vector_store: LanceDB,
+        text: str,
+        source_filter: Optional[str] = None,
+        tool_use_id: str = DEFAULT_TOOL_USE_ID,
+        k: Optional[int] = None,
+        limiter: Optional[anyio.CapacityLimiter] = None
+) -> ToolResultBlock:
+    try:
+        content = await aperform_retrieval(vector_store, text, source_filter, k, limiter)
+        return ToolResultBlock(
+            toolUseId=tool_use_id,
+            content=content,
+            status="success"
+        )
+    except Exception as error:
+        logger.exception("Search tool error")
+        return ToolResultBlock(
+            toolUseId=tool_use_id,
+            content=[ToolResultContentBlock(text="An internal error occurred during search.")],
+            status="error"
+        )
+
 def execute_search_tool(
         vector_store: LanceDB,
         text: str,
@@ -46,6 +100,52 @@ def execute_search_tool(
             status="error"
         )
 
+async def aexecute_multi_search_tool(
+        vector_store: LanceDB,
+        queries: List[dict],
+        k: Optional[int] = None,
+        limiter: Optional[anyio.CapacityLimiter] = None
+) -> List[ToolResultBlock]:
+    """
+    Search several queries ({"text": ..., "source": optional filter}) at once: the texts are embedded in one batched
+    call and the queries sharing a filter run as one vectorized LanceDB search.
+
+    :return: one ToolResultBlock per query, in order, with toolUseId "query_<index>"
+    """
+    try:
+        embeddings = await vector_store.embeddings.aembed_documents([query["text"] for query in queries])
+        by_filter = {}
+        for i, query in enumerate(queries):
+            by_filter.setdefault(query.get("source"), []).append(i)
+
+        def search():
+            table = vector_store.get_table()
+            results = {}
+            for source_filter, indices in by_filter.items():
+                search = table.search([embeddings[i] for i in indices]).limit(k or DEFAULT_K)
+                if source_filter:
+                    search = search.where(source_where(source_filter), prefilter=True)
+                for row in search.select(["text", "metadata"]).to_list():
+                    # query_index is the position of the vector within this batch
+                    results.setdefault(indices[row.get("query_index", 0)], []).append(row)
+            return results
+
+        results = await anyio.to_thread.run_sync(search, limiter=limiter)
+    except Exception as error:
+        logger.exception("Multi search tool error")
+        return [ToolResultBlock(
+            toolUseId=f"query_{i}",
+            content=[ToolResultContentBlock(text="An internal error occurred during search.")],
+            status="error"
+        ) for i in range(len(queries))]
+
+    return [ToolResultBlock(
+        toolUseId=f"query_{i}",
+        content=[ToolResultContentBlock(json={"source": row["metadata"]["source"], "text": row["text"]})
+                 for row in results.get(i, [])],
+        status="success"
+    ) for i in range(len(queries))]
+
 # Wrappers for backward compatibility
 def broad_search_tool(vector_store: LanceDB, text: str) -> ToolResultBlock:
     return execute_search_tool(vector_store, text)
@@ -8,6 +8,8 @@ from litellm.types.llms.bedrock import ToolResultBlock, ToolResultContentBlock
 # from llama_cloud import ImageBlock
 from pydantic import BaseModel, Field
 
+from lance_db_mcp_with_sse.python.src.tools.tools import source_where
+
 
 class McpError(Exception):
     class ErrorCode:
@@ -161,16 +163,13 @@ class ChunksSearchTool(BaseTool[ChunksSearchParams]):
 
     def execute(self, params: ChunksSearchParams) -> ToolResultBlock:
         try:
-            retriever = self.vector_store.as_retriever()
+            # only chunks of the source are searched, using the index on the source column
+            retriever = self.vector_store.as_retriever(
+                search_kwargs={"filter": source_where(params.source), "prefilter": True})
             results = retriever.invoke(params.text)
 
-            print("Filtering out all results not from source", params.source)
-
-            # Filter results by source if provided
-            filtered_results = [doc for doc in results if doc.metadata["source"].replace('\\\\', '\\') == params.source.replace('\\\\', '\\')]
-
             content = [ToolResultContentBlock(json={ "source": doc.metadata["source"], "text": doc.page_content }
-                                              ) for doc in filtered_results]
+                                              ) for doc in results]
             return ToolResultBlock(
                 toolUseId="placeholder_toolUseId",
                 content=content,
@@ -1,31 +1,29 @@
-# pip install llama-index llama-index-embeddings-huggingface llama-index-readers-web llama-index-vector-stores-lancedb diffusers huggingface-hub -q
+# pip install llama-index llama-index-embeddings-huggingface llama-index-readers-web llama-index-vector-stores-lancedb diffusers huggingface-hub pylance -q
 import os
 
 # adopted from https://colab.research.google.com/github/lancedb/vectordb-recipes/blob/main/tutorials/RAG-with_MatryoshkaEmbed-Llamaindex/RAG_with_MatryoshkaEmbedding_and_Llamaindex.ipynb#scrollTo=hgVHOEBZ2lS5
 
-from llama_index.core import VectorStoreIndex, Settings, StorageContext
-from llama_index.core.ingestion import IngestionPipeline
+from llama_index.core import VectorStoreIndex, Settings
 from llama_index.vector_stores.lancedb import LanceDBVectorStore
 from llama_index.llms.openai import OpenAI
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 import lancedb
 import asyncio
 
-from data_utils import chunk_documents, time_block, download_pdfs, pdf_urls
-from lance_vector_database_on_s3.data_utils import crawl_lancedb_guides
-from setup import assume_limited_role
+from embedding_cache import CachedLlamaEmbedding, EmbeddingCache
+from data_utils import chunk_documents, time_block, download_pdfs, pdf_urls, load_manifest, save_manifest
+from lance_vector_database_on_s3.data_utils import crawl_lancedb_guides, clear_pending_changes
+from document_store import _in_filters
+from metrics import REGISTRY, span
+from streaming_ingest import stream_ingest
 
 
 def connect(db_uri, credentials):
+    """`credentials` is a `RoleCredentialProvider`; the connection keeps the credentials current when it was opened."""
     try:
         db = lancedb.connect(
             db_uri,
-            storage_options={
-                "timeout": "60s",
-                "aws_region": "us-west-1",
-                "aws_access_key_id": credentials['AccessKeyId'],
-                "aws_secret_access_key": credentials['SecretAccessKey'],
-                "aws_session_token": credentials['SessionToken'], }
+            storage_options=credentials.storage_options(timeout="60s")
         )
         print("Connected to LanceDB.")
     except Exception as e:
@@ -37,11 +35,15 @@ def connect(db_uri, credentials):
 
 def build_RAG(
         input_data_dir, db,
-        table_name
+        table_name, batch_size=64, num_workers=2, queue_depth=4, changed_paths=None, credentials=None
 ):
     """
     This function sets embedding model, llm, and vector store to be used for creating RAG index.
-    If changes are detected in the input data directory, the vector store is cleared and recreated.
+    Only documents from files added or modified since the last run are embedded; rows for modified and
+    deleted files are removed from the vector store first. Changed documents are streamed through the
+    ingestion stages `batch_size` documents at a time. `changed_paths` limits change detection to the files
+    a crawl reported as changed. With `credentials` (the provider `db` was connected with), a long ingestion
+    reconnects when the assumed role credentials are refreshed.
     """
 
     # Set the language model
@@ -51,41 +53,59 @@ def build_RAG(
     if db is None:
         raise ValueError("A valid LanceDB connection (`db`) must be provided.")
 
-    # Initialize the LanceDBVectorStore
-    vector_store = LanceDBVectorStore(uri=db_uri, table_name=table_name)
-
-    # Initialize storage context
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
-    changes, documents = chunk_documents(input_data_dir)
+    # Initialize the LanceDBVectorStore, appending so that unchanged documents are kept
+    vector_store = LanceDBVectorStore(uri=db.uri, table_name=table_name, connection=db, mode="append")
+    generation = credentials.generation if credentials else None
+
+    def current_vector_store():
+        nonlocal db, vector_store, generation
+        if credentials is not None:
+            credentials.get()
+            if credentials.generation != generation:
+                db = connect(db.uri, credentials)
+                vector_store = LanceDBVectorStore(uri=db.uri, table_name=table_name, connection=db, mode="append")
+                generation = credentials.generation
+        return vector_store
+
+    first_run = load_manifest(input_data_dir) is None
+    with time_block("chunk_documents"):
+        diff, document_store = chunk_documents(input_data_dir, changed_paths)
     # Check for changes in the input data directory
-    if changes:  # changes_detected(input_data_dir):
-        # If changes are detected, clear the vector store
-        print("Changes detected in the input data. Clearing and recreating the vector store.")
-        tables = db.table_names()
-        if table_name in tables:
-            table = db.open_table(table_name)
-            table.delete("1=1")  # Clear the LanceDB table
-            print(f"Cleared the '{table_name}' table.")
-        # Recreate the index from the documents
-        with (time_block("VectorStoreIndex creation")):
-
-            pipeline = IngestionPipeline(
-                transformations=Settings.transformations
-            )
-            async def run_pipeline():
-                return await pipeline.arun(documents=documents, num_workers=12, show_progress=True)
-
-            nodes = asyncio.run(run_pipeline())
-
-            index = VectorStoreIndex(nodes=nodes, storage_context=storage_context, show_progress=True)
-            print("Index created.")
-            # index = VectorStoreIndex.from_documents(documents,
-            #                                         storage_context=storage_context,
-            #                                         show_progress=True)
+    if diff.has_changes:
+        print(f"Changes detected in the input data: {len(diff.added)} added, {len(diff.modified)} modified, "
+              f"{len(diff.deleted)} deleted.")
+        if table_name in db.table_names():
+            if first_run:
+                # rows written before the manifest existed can't be matched to files
+                db.open_table(table_name).delete("1=1")
+                print(f"Cleared the '{table_name}' table.")
+            else:
+                # added files too: a failed run may have written part of their nodes (doc ids are file names,
+                # so they are the same on the retry)
+                doc_ids = diff.stale_doc_ids + [doc_id for rel_path in diff.added
+                                                for doc_id in diff.manifest[rel_path]['doc_ids']]
+                table = db.open_table(table_name)
+                with span("delete_stale_documents", documents=len(doc_ids)):
+                    # one delete commit per batch of ids rather than per document
+                    for predicate in _in_filters("doc_id", doc_ids):
+                        table.delete(predicate)
+                print(f"Removed {len(doc_ids)} stale documents from the '{table_name}' table.")
+
+        with (time_block("VectorStoreIndex update")):
+            # load, embed and write overlap; at most `queue_depth` batches are in flight between stages
+            stats = asyncio.run(stream_ingest(
+                document_store.iter_batches(batch_size=batch_size, file_paths=diff.changed),
+                Settings.transformations, Settings.embed_model, current_vector_store,
+                num_workers=num_workers, queue_depth=queue_depth,
+            ))
+            print(f"Index updated with {stats['nodes']} nodes from {stats['documents']} documents.")
+        index = VectorStoreIndex.from_vector_store(current_vector_store())
+
+        # only record the new manifest once the table reflects it
+        save_manifest(input_data_dir, diff.manifest)
     else:
         # Use the existing vector store if no changes are detected
-        print("Data should already be vectorized and stored in the database, but the hash depends only on changes detected 'locally'.")
+        print("No changes detected in the input data. Using the existing vector store.")
         index = VectorStoreIndex.from_vector_store(vector_store)
 
     tables = db.table_names()
@@ -108,6 +128,8 @@ def interactive_session():
 
 
 if __name__ == "__main__":
+    from serverless_rag_with_lambda_lance_bedrock.rag_lambda.python.credentials import RoleCredentialProvider
+
     with time_block("Creating AWS Resources"):
         # Unique name for your project
         #   (also used for s3 bucket so no spaces or underscores)
@@ -118,7 +140,8 @@ if __name__ == "__main__":
         bucket_name = project_id + 'lancedb-on-s3'
 
         #setup_cloud_resources(bucket_name, role_name, policy_name, region='us-west-1')
-        credentials = assume_limited_role(role_name, region='us-west-1')
+        # refreshed in the background before the assumed role credentials expire
+        credentials = RoleCredentialProvider(role_name, region='us-west-1')
 
         input_data_dir = "data"
         if not os.path.exists(input_data_dir):
@@ -126,6 +149,7 @@ if __name__ == "__main__":
 
         # set this to True when ready to use the Gale Encyclopedia of Medicine PDFs
         using_gale_encyclopedia_of_medicine = False
+        changed_paths = None
 
         if using_gale_encyclopedia_of_medicine:
             db_name = "gale-encyclopedia-of-medicine"
@@ -138,7 +162,8 @@ if __name__ == "__main__":
         else:
             db_name = "lancedb-docs"
             with time_block("Crawl LanceDB Docs"):
-                asyncio.run(crawl_lancedb_guides())
+                # only the pages the crawl wrote or deleted need to be re-indexed
+                changed_paths = asyncio.run(crawl_lancedb_guides(input_data_dir))
 
 
         db_uri = f"s3://{bucket_name}/{db_name}/"
@@ -147,16 +172,30 @@ if __name__ == "__main__":
 
         # Set the embedding model
         #Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small")
-        Settings.embed_model = HuggingFaceEmbedding(
-            model_name=embedding_model,  # matryoshka_embedding_model,
-            truncate_dim=int(matryoshka_embedding_size),
+        embedding_cache = EmbeddingCache()
+        Settings.embed_model = CachedLlamaEmbedding(
+            HuggingFaceEmbedding(
+                model_name=embedding_model,  # matryoshka_embedding_model,
+                truncate_dim=int(matryoshka_embedding_size),
+            ),
+            cache=embedding_cache,
+            dim=int(matryoshka_embedding_size),
         )
 
         db = connect(db_uri, credentials)
 
         query_engine = build_RAG(
             input_data_dir, db,
-            table_name=db_name # also database name
+            table_name=db_name, # also database name
+            changed_paths=changed_paths,
+            credentials=credentials
         )
+        if changed_paths is not None:
+            clear_pending_changes(input_data_dir)
+        embedding_cache.flush()
+
+        # where did the ingestion time go
+        REGISTRY.export_jsonl("metrics.jsonl")
+        REGISTRY.write_prometheus("metrics.prom")
 
         interactive_session()
@@ -0,0 +1,109 @@
+import asyncio
+import random
+import time
+from urllib.parse import urlparse
+
+from metrics import counter
+
+# errors that won't go away by asking again
+PERMANENT_STATUS_CODES = {400, 401, 403, 404, 410}
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class CrawlScheduler:
+    """
+    Runs a handler over a list of urls with at most `concurrency` in flight, a token bucket per host and retries
+    with exponential backoff. Each url is handled as soon as it is done, so nothing accumulates in memory.
+    """
+
+    def __init__(self, concurrency=8, rate_per_host=4.0, burst=None, max_retries=3, backoff=1.0):
+        self.concurrency = concurrency
+        self.rate_per_host = rate_per_host
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.buckets = {}
+
+    async def throttle(self, url):
+        host = urlparse(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate_per_host, self.burst)
+        await self.buckets[host].acquire()
+
+    async def crawl(self, crawler, url, config):
+        """Crawl one url, retrying failed results. Returns the last result."""
+        for attempt in range(self.max_retries + 1):
+            await self.throttle(url)
+            try:
+                result = await crawler.arun(url=url, config=config)
+            except Exception as e:
+                result = None
+                print(f"Error crawling {url}: {e}")
+            if result is not None and (result.success or result.status_code in PERMANENT_STATUS_CODES):
+                return result
+            if attempt < self.max_retries:
+                await self._backoff(attempt)
+        return result
+
+    async def request(self, url, fetch):
+        """
+        Run the blocking `fetch(url)` (an HTTP request returning its response) in a thread, retrying exceptions,
+        429 and 5xx responses like `crawl`. Returns the last response, or raises the last exception.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.throttle(url)
+            try:
+                response = await asyncio.to_thread(fetch, url)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Error requesting {url}: {e}")
+            else:
+                if (response.status_code != 429 and response.status_code < 500) or attempt == self.max_retries:
+                    return response
+            await self._backoff(attempt)
+
+    async def _backoff(self, attempt):
+        counter("crawl_retries_total", "Crawl attempts that were retried").inc()
+        delay = self.backoff * 2 ** attempt
+        await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+    async def run(self, urls, handler):
+        """Call `await handler(url)` for every url with the configured concurrency."""
+        queue = asyncio.Queue()
+        for url in urls:
+            queue.put_nowait(url)
+
+        async def worker():
+            while True:
+                try:
+                    url = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await handler(url)
+                except Exception as e:
+                    print(f"Failed to process {url}: {e}")
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(urls)) or 1)))
@@ -1,15 +1,25 @@
 from pathlib import Path
-import hashlib, json, pickle
+import hashlib, json
 from llama_index.core import SimpleDirectoryReader
 import aiofiles
 from usp.tree import sitemap_from_str
 import os
 import asyncio
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from crawl4ai import AsyncWebCrawler, CrawlerRunConfig
 
+from crawl_scheduler import CrawlScheduler
+from metrics import counter, histogram, span
+from document_store import DocumentStore
+
+import contextvars
 import time
 from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import List
 
 # download the pdfs from the google drive file_ids
 pdf_urls = [
@@ -19,87 +29,295 @@ pdf_urls = [
     "0B7HZIUBvCH1EZ1REYVFnYjZscTQ"
 ]
 
+GOOGLE_DRIVE_URL = "https://drive.usercontent.google.com/u/0/uc?id={id}&export=download"
+# read and write downloads in 1 MB blocks
+DOWNLOAD_BUFFER_SIZE = 1 << 20
+
+
+def create_download_session(pool_size=8, retries=3):
+    """A pooled session that retries connection errors and 429/5xx responses with backoff."""
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET", "HEAD"))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _total_size(response, offset):
+    """The full size of the file from Content-Range (206/416) or Content-Length (200), if the server sent one."""
+    content_range = response.headers.get("Content-Range")
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get("Content-Length")
+    if not content_length:
+        return None
+    # a 200 is the whole file, even when a range was asked for
+    return int(content_length) if response.status_code == 200 else offset + int(content_length)
+
+
 # Function to download the PDF
 # https://drive.usercontent.google.com/u/0/uc?id=0B7HZIUBvCH1EVGxpNEdXVklLQk0&export=download
-def download_pdf(google_doc_id, filename):
-    response = requests.get(f"https://drive.usercontent.google.com/u/0/uc?id={google_doc_id}&export=download", stream=True)
-    if response.status_code == 200:
-        with open(filename, "wb") as pdf_file:
-            for chunk in response.iter_content(chunk_size=1024):
-                pdf_file.write(chunk)
+def download_pdf(google_doc_id, filename, session=None, url_template=GOOGLE_DRIVE_URL, expected_sha256=None,
+                 attempts=3):
+    """
+    Download to `filename + '.part'`, resuming a partial file with a Range request, and rename it into place
+    once the size (and `expected_sha256`, if given) checks out.
+
+    :return: True if the file was downloaded
+    """
+    session = session or create_download_session(pool_size=1)
+    url = url_template.format(id=google_doc_id)
+    part_path = filename + ".part"
+    downloaded_bytes = counter("download_bytes_total", "Bytes downloaded")
+    start = time.perf_counter()
+
+    for attempt in range(1, attempts + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=60) as response:
+                total = _total_size(response, offset)
+                if response.status_code == 416:
+                    # nothing left to fetch, unless the partial file is bigger than the remote one
+                    if total != offset:
+                        os.remove(part_path)
+                        continue
+                elif response.status_code in (200, 206):
+                    # a 200 means the server ignored the range, so start over
+                    mode = "ab" if response.status_code == 206 else "wb"
+                    with open(part_path, mode, buffering=DOWNLOAD_BUFFER_SIZE) as pdf_file:
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_BUFFER_SIZE):
+                            pdf_file.write(chunk)
+                            downloaded_bytes.inc(len(chunk))
+                else:
+                    print(f"Failed to download: {filename} - Status Code: {response.status_code}")
+                    counter("downloads_total", "Files downloaded").inc(status="failed")
+                    return False
+        except requests.RequestException as e:
+            print(f"Download of {filename} interrupted (attempt {attempt}/{attempts}): {e}")
+            continue
+
+        size = os.path.getsize(part_path)
+        if total is not None and size != total:
+            print(f"Incomplete download of {filename}: {size} of {total} bytes (attempt {attempt}/{attempts})")
+            continue
+        if expected_sha256 and file_hash(part_path) != expected_sha256:
+            print(f"Checksum mismatch for {filename} (attempt {attempt}/{attempts})")
+            os.remove(part_path)
+            continue
+
+        os.replace(part_path, filename)
         print(f"Downloaded: {filename}")
-    else:
-        print(f"Failed to download: {filename} - Status Code: {response.status_code}")
+        counter("downloads_total", "Files downloaded").inc(status="ok")
+        histogram("download_seconds", "Time to download one file").observe(time.perf_counter() - start)
+        return True
 
+    print(f"Failed to download: {filename} after {attempts} attempts")
+    counter("downloads_total", "Files downloaded").inc(status="failed")
+    return False
 
-def download_pdfs(google_doc_ids):
-    # Loop through the URLs and download each PDF
-    for index, id in enumerate(google_doc_ids):
-        # Generate the filename
-        filename = f"data/document_{index + 1}.pdf"
-        # Download the PDF
-        download_pdf(id, filename)
 
-def chunk_documents(input_data_dir):
+def download_pdfs(google_doc_ids, output_dir="data", max_workers=4, url_template=GOOGLE_DRIVE_URL, checksums=None):
     """
+    Download the PDFs concurrently over one pooled session. Repeated ids are downloaded once and files that
+    already exist are skipped.
 
-    :param input_data_dir:
-    :return: a tuple indicating whether there are changes and the documents (changes, documents)
-    """
-    doc_dir = os.path.join(input_data_dir, "documents.pkl")
-    """Calculate a hash based on the contents of the directory."""
-    hash_obj = hashlib.md5()
-    for root, _, files in os.walk(input_data_dir):
-        for file in sorted(files):  # Ensure consistent order
-            # don't read the 'hash.json' file
-            if file != 'hash.json' and file != 'documents.pkl':
-                with open(os.path.join(root, file), 'rb') as f:
-                    hash_obj.update(f.read())
-    current_hash = hash_obj.hexdigest()
-
-    # Check if hash file exists and compare hashes
-    hash_path = os.path.join(input_data_dir, "hash.json")
-
-    if os.path.exists(hash_path):
-        with open(hash_path, 'r') as f:
-            saved_hash = json.load(f).get('hash')
+    :param checksums: optional dict of id -> expected sha256
+    :return: the list of downloaded (or already present) file names
+    """
+    checksums = checksums or {}
+    unique_ids = list(dict.fromkeys(google_doc_ids))
+    os.makedirs(output_dir, exist_ok=True)
+
+    session = create_download_session(pool_size=max_workers)
+    with span("download_pdfs", files=len(unique_ids)), session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for index, id in enumerate(unique_ids):
+            # Generate the filename
+            filename = os.path.join(output_dir, f"document_{index + 1}.pdf")
+            if os.path.exists(filename):
+                futures[filename] = None
+                continue
+            # run in a copy of the context so the downloads are recorded under the download_pdfs span
+            futures[filename] = executor.submit(contextvars.copy_context().run, download_pdf, id, filename, session,
+                                                url_template, checksums.get(id))
+        return [filename for filename, future in futures.items() if future is None or future.result()]
+
+
+MANIFEST_FILE = "manifest.json"
+CRAWL_STATE_FILE = "crawl_state.json"
+DOCUMENT_STORE_DIR = "documents.lance"
+# files and directories written by chunk_documents itself, never part of the corpus
+CACHE_FILES = {"hash.json", "documents.pkl", MANIFEST_FILE, CRAWL_STATE_FILE}
+CACHE_DIRS = {DOCUMENT_STORE_DIR}
+
+
+@dataclass
+class ManifestDiff:
+    """
+    The result of comparing the input directory against the saved manifest. Paths are relative to the
+    input directory. `manifest` is the updated manifest; save it once the changes have been indexed.
+    """
+    added: List[str] = field(default_factory=list)
+    modified: List[str] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+    stale_doc_ids: List[str] = field(default_factory=list)
+    manifest: dict = field(default_factory=dict)
+
+    @property
+    def changed(self):
+        return self.added + self.modified
+
+    @property
+    def has_changes(self):
+        return bool(self.added or self.modified or self.deleted)
+
+
+def file_hash(file_path, block_size=1 << 20):
+    hash_obj = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hash_obj.update(block)
+    return hash_obj.hexdigest()
+
+
+def load_manifest(input_data_dir):
+    manifest_path = os.path.join(input_data_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_json(path, obj):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def save_manifest(input_data_dir, manifest):
+    write_json(os.path.join(input_data_dir, MANIFEST_FILE), manifest)
+
+
+def _diff_file(input_data_dir, rel_path, entry, diff):
+    path = os.path.join(input_data_dir, rel_path)
+    stat = os.stat(path)
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        diff.unchanged.append(rel_path)
+        diff.manifest[rel_path] = entry
+        return
+
+    current_hash = file_hash(path)
+    if entry and entry['sha256'] == current_hash:
+        # touched but not modified, just refresh the stat fields
+        diff.unchanged.append(rel_path)
+        diff.manifest[rel_path] = dict(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        return
+
+    if entry:
+        diff.modified.append(rel_path)
+        diff.stale_doc_ids.extend(entry.get('doc_ids', []))
     else:
-        saved_hash = None
-
-    if saved_hash == current_hash:
-        changes = False
-        if os.path.exists(os.path.join(input_data_dir, "documents.pkl")):
-            with open(doc_dir, "rb") as f:
-                documents = pickle.load(f)
-            return changes, documents
-        else:
-            # Load new documents from the input directory
-            documents = SimpleDirectoryReader(input_data_dir, exclude=["hash.json", "documents.pkl"]).load_data()
-            return changes, documents
+        diff.added.append(rel_path)
+    diff.manifest[rel_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': current_hash,
+                               'doc_ids': []}
+
+
+def diff_manifest(input_data_dir, manifest, candidates=None):
+    """
+    Compare the files in `input_data_dir` with the manifest entries keyed on (size, mtime, sha256).
+    Only files whose size or mtime changed are read and hashed, so an unchanged corpus costs one stat per file.
 
+    If `candidates` (paths relative to `input_data_dir`) is given, e.g. the files a crawl reported as changed,
+    only those are checked and every other manifest entry is carried over without touching the directory.
+    """
+    manifest = manifest or {}
+    diff = ManifestDiff()
+    if candidates is None:
+        for root, dirs, files in os.walk(input_data_dir):
+            dirs[:] = [d for d in dirs if d not in CACHE_DIRS]
+            for file in sorted(files):
+                if file in CACHE_FILES or file.endswith(".tmp"):
+                    continue
+                rel_path = os.path.relpath(os.path.join(root, file), input_data_dir)
+                _diff_file(input_data_dir, rel_path, manifest.get(rel_path), diff)
     else:
-        changes = True
-        documents = SimpleDirectoryReader(input_data_dir).load_data()
-        # Save the new hash
-        with open(hash_path, 'w') as f:
-            json.dump({'hash': current_hash}, f)
-        with open(doc_dir, "wb") as f:
-            pickle.dump(documents, f)
-        return changes, documents
+        candidates = set(candidates)
+        for rel_path, entry in manifest.items():
+            if rel_path not in candidates:
+                diff.unchanged.append(rel_path)
+                diff.manifest[rel_path] = entry
+        for rel_path in sorted(candidates):
+            if os.path.exists(os.path.join(input_data_dir, rel_path)):
+                _diff_file(input_data_dir, rel_path, manifest.get(rel_path), diff)
+
+    for rel_path, entry in manifest.items():
+        if rel_path not in diff.manifest:
+            diff.deleted.append(rel_path)
+            diff.stale_doc_ids.extend(entry.get('doc_ids', []))
+    return diff
+
+
+def chunk_documents(input_data_dir, changed_paths=None):
+    """
+    Detect added, modified and deleted files in the input directory and load only the added and modified
+    ones into the document store. Read the changed documents back with
+    `store.iter_batches(file_paths=diff.changed)`. When there are no changes, the refreshed stat fields of files
+    that were only touched are saved to the manifest here.
+
+    :param input_data_dir:
+    :param changed_paths: optional list of the only files that may have changed (see `diff_manifest`)
+    :return: a tuple of the manifest diff and the document store (diff, store)
+    """
+    store = DocumentStore(os.path.join(input_data_dir, DOCUMENT_STORE_DIR))
+    manifest = load_manifest(input_data_dir)
+    with span("diff_manifest"):
+        # without a manifest every file is new, so the hint can't be used
+        diff = diff_manifest(input_data_dir, manifest, changed_paths if manifest is not None else None)
+    files_changed = counter("files_changed_total", "Input files detected as changed")
+    files_changed.inc(len(diff.added), change="added")
+    files_changed.inc(len(diff.modified), change="modified")
+    files_changed.inc(len(diff.deleted), change="deleted")
+
+    # a store that predates the manifest, or was removed, is rebuilt from the files on disk
+    backfill = diff.unchanged if not store.exists else []
+    if diff.has_changes or backfill:
+        docs_loaded = counter("docs_loaded_total", "Documents loaded from the input files")
+        with span("load_documents", files=len(diff.changed) + len(backfill)):
+            # added files too: a run that failed before saving the manifest may have stored them already
+            store.delete(diff.changed + diff.deleted)
+            for rel_path in diff.changed + backfill:
+                file_docs = SimpleDirectoryReader(input_files=[os.path.join(input_data_dir, rel_path)],
+                                                  filename_as_id=True).load_data()
+                diff.manifest[rel_path]['doc_ids'] = [doc.doc_id for doc in file_docs]
+                store.add(rel_path, file_docs)
+                docs_loaded.inc(len(file_docs))
+            store.flush()
+            if diff.modified or diff.deleted:
+                store.compact()
 
+    if not diff.has_changes and manifest is not None and diff.manifest != manifest:
+        # only the stat fields of touched files (or the doc ids of a rebuilt store) changed, so there is nothing
+        # to re-index; without saving them every later run would hash those files again
+        save_manifest(input_data_dir, diff.manifest)
 
+    return diff, store
 
 
 @contextmanager
-def time_block(label):
-    start = time.perf_counter()
+def time_block(label, **attributes):
+    """Print the duration of a block and record it as a (nested) metrics span."""
     print(f"starting {label}")
-    try:
-        yield
-    finally:
-        end = time.perf_counter()
-        elapsed = end - start
-        print(f"{label}: {elapsed:.4f} seconds")
+    with span(label, **attributes) as current:
+        try:
+            yield current
+        finally:
+            print(f"{label}: {current.duration:.4f} seconds")
 
 async def save_content_to_file(url, content, output_dir):
     # Ensure the output directory exists
@@ -119,49 +337,171 @@ def generate_filename_from_url(url):
     filename = url.replace("https://", "").replace("/", "_") + ".md"
     return filename
 
-async def crawl_lancedb_guides(output_directory="data"):
+def load_crawl_state(output_directory):
+    state_path = os.path.join(output_directory, CRAWL_STATE_FILE)
+    if not os.path.exists(state_path):
+        return {"sitemap": {}, "pages": {}}
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+
+def save_crawl_state(output_directory, state):
+    os.makedirs(output_directory, exist_ok=True)
+    write_json(os.path.join(output_directory, CRAWL_STATE_FILE), state)
+
+
+def conditional_headers(entry):
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def fetch_sitemap(session, sitemap_url, state):
+    """
+    Return {url: lastmod} for the pages in the sitemap, re-using the parsed result from the crawl state when the
+    server answers the conditional request with 304 Not Modified.
+    """
+    sitemap_state = state["sitemap"]
+    response = session.get(sitemap_url, headers=conditional_headers(sitemap_state), timeout=60)
+    if response.status_code == 304 and "urls" in sitemap_state:
+        print("Sitemap not modified since the last crawl.")
+        return sitemap_state["urls"]
+    response.raise_for_status()
+
+    parsed_sitemap = sitemap_from_str(response.text)
+    urls = {page.url: page.last_modified.isoformat() if page.last_modified else None
+            for page in parsed_sitemap.all_pages()}
+    state["sitemap"] = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"),
+                        "urls": urls}
+    return urls
+
+
+def _conditional_get(session, url, entry):
+    # streamed and closed unread: the body is only needed when the page changed, and crawl4ai fetches it then
+    with session.get(url, headers=conditional_headers(entry), timeout=60, stream=True) as response:
+        return response
+
+
+async def page_changed(scheduler, session, url, lastmod, entry, file_path):
+    """
+    Decide whether a page has to be crawled again: the sitemap <lastmod> is checked first, then the page is
+    requested with If-None-Match/If-Modified-Since through the scheduler's rate limit and retries. Updates `entry`
+    with the validators of the response.
+    """
+    if not file_path.exists() or not entry:
+        return True
+    if lastmod and entry.get("lastmod") == lastmod:
+        return False
+    try:
+        response = await scheduler.request(url, lambda url: _conditional_get(session, url, entry))
+    except Exception as e:
+        print(f"Checking {url} for changes failed, crawling it: {e}")
+        return True
+    entry["lastmod"] = lastmod
+    if response.status_code == 304:
+        return False
+    if response.status_code == 200:
+        entry["etag"] = response.headers.get("ETag")
+        entry["last_modified"] = response.headers.get("Last-Modified")
+    return True
+
+
+async def crawl_lancedb_guides(output_directory="data", concurrency=8, rate_per_host=4.0, max_retries=3,
+                               on_page=None):
+    """
+    Crawl the LanceDB guides, fetching only pages that are new or changed since the last crawl.
+
+    Pages are checked, crawled and written one url at a time by a `CrawlScheduler` (at most `concurrency` in
+    flight, `rate_per_host` requests per second). If given, `await on_page(filename)` is called as soon as each
+    page is written, so downstream chunking can start before the crawl is done.
+
+    :return: the file names (relative to `output_directory`) written or deleted since the last
+        `clear_pending_changes`, for re-indexing
+    """
     sitemap_url = "https://lancedb.github.io/lancedb/sitemap.xml"
+    state = load_crawl_state(output_directory)
+    pages = state["pages"]
+    session = create_download_session(pool_size=concurrency)
+    scheduler = CrawlScheduler(concurrency=concurrency, rate_per_host=rate_per_host, max_retries=max_retries)
+
+    pages_crawled = counter("crawl_pages_total", "Pages processed by the crawler, by outcome")
+    crawl_seconds = histogram("crawl_page_seconds", "Time to crawl one page, including retries")
 
     # Parse the sitemap to extract URLs
-    site_map = requests.get(sitemap_url).text
-    parsed_sitemap = sitemap_from_str(site_map)
-    urls = [page.url for page in parsed_sitemap.all_pages()]
+    with span("fetch_sitemap"):
+        sitemap = await asyncio.to_thread(fetch_sitemap, session, sitemap_url, state)
 
-    # Configure the crawler for concurrent requests
     run_config = CrawlerRunConfig()
 
     # filter urls to only include those that start with https://lancedb.github.io/lancedb
-    urls = [url for url in urls if url.startswith("https://lancedb.github.io/lancedb")]
+    urls = [url for url in sitemap if url.startswith("https://lancedb.github.io/lancedb")]
     # exclude urls with /lancedb/javascript/ or /lancedb/python/ or /lancedb/js/
     urls = [url for url in urls if all(exclusion not in url for exclusion in ["/lancedb/javascript/",
                                                                               "/lancedb/python/", "/lancedb/js/",
                                                                               "/lancedb/examples/", "/lancedb/notebooks/","/lancedb/embeddings/"])]
 
-    urls_not_downloaded = []
-    for url in urls:
-        file_path = Path(output_directory) / generate_filename_from_url(url)
+    changed_files = []
 
-        # Check if the file already exists
+    # pages dropped from the sitemap are removed so they get deleted from the index too
+    for url in set(pages) - set(urls):
+        filename = generate_filename_from_url(url)
+        file_path = Path(output_directory) / filename
         if file_path.exists():
-            continue
-        else:
-            urls_not_downloaded.append(url)
-
+            file_path.unlink()
+        changed_files.append(filename)
+        del pages[url]
 
     async with AsyncWebCrawler() as crawler:
-        # Crawl all URLs concurrently
-        results = await crawler.arun_many(urls_not_downloaded, config=run_config)
-
-        # Process and save the results
-        tasks = []
-        for result in results:
-            if result.success:
-                tasks.append(save_content_to_file(result.url, result.markdown, output_directory))
-            else:
-                print(f"Failed to crawl {result.url}: {result.error_message}")
-
-        # Await all save tasks
-        await asyncio.gather(*tasks)
+        async def process(url):
+            entry = pages.setdefault(url, {})
+            filename = generate_filename_from_url(url)
+            file_path = Path(output_directory) / filename
+
+            if not await page_changed(scheduler, session, url, sitemap[url], entry, file_path):
+                pages_crawled.inc(outcome="not_modified")
+                return
+
+            start = time.perf_counter()
+            result = await scheduler.crawl(crawler, url, run_config)
+            crawl_seconds.observe(time.perf_counter() - start)
+            if result is None or not result.success:
+                print(f"Failed to crawl {url}: {result.error_message if result else 'no result'}")
+                pages_crawled.inc(outcome="failed")
+                # forget the validators so the page is fetched again next time
+                pages.pop(url, None)
+                return
+
+            entry["lastmod"] = sitemap[url]
+            content_hash = hashlib.sha256(result.markdown.encode('utf-8')).hexdigest()
+            # a new ETag doesn't always mean new content, only write pages that really differ
+            if entry.get("sha256") == content_hash and file_path.exists():
+                pages_crawled.inc(outcome="unchanged")
+                return
+            entry["sha256"] = content_hash
+            await save_content_to_file(url, result.markdown, output_directory)
+            pages_crawled.inc(outcome="written")
+            changed_files.append(filename)
+            if on_page:
+                await on_page(filename)
+
+        with span("crawl_pages", urls=len(urls)):
+            await scheduler.run(urls, process)
+
+    print(f"{len(changed_files)} of {len(urls)} pages are new, changed or removed.")
+
+    # changes stay pending until clear_pending_changes is called, so a failed re-index picks them up next time
+    state["pending"] = sorted(set(state.get("pending", [])) | set(changed_files))
+    save_crawl_state(output_directory, state)
+    return state["pending"]
+
+
+def clear_pending_changes(output_directory):
+    state = load_crawl_state(output_directory)
+    state["pending"] = []
+    save_crawl_state(output_directory, state)
 
 
 # async def save_content_to_file(url, content, output_dir):
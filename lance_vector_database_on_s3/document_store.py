@@ -0,0 +1,109 @@
+import json
+import os
+
+import lance
+import pyarrow as pa
+from llama_index.core import Document
+
+SCHEMA = pa.schema([
+    pa.field("doc_id", pa.string()),
+    pa.field("file_path", pa.string()),  # relative to the input directory, as in the manifest
+    pa.field("text", pa.large_string()),
+    pa.field("metadata", pa.string()),  # json encoded document metadata
+    # the metadata keys left out of the embedded text and of the LLM context, e.g. file dates
+    pa.field("excluded_embed_metadata_keys", pa.list_(pa.string())),
+    pa.field("excluded_llm_metadata_keys", pa.list_(pa.string())),
+])
+
+# keep IN (...) filters to a reasonable size
+MAX_FILTER_VALUES = 1000
+
+
+def _quote(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _in_filters(column, values):
+    values = list(values)
+    for i in range(0, len(values), MAX_FILTER_VALUES):
+        yield f"{column} IN ({', '.join(_quote(v) for v in values[i:i + MAX_FILTER_VALUES])})"
+
+
+class DocumentStore:
+    """
+    Document cache stored as a Lance dataset.
+
+    Reads stream record batches from the dataset files rather than loading the corpus, and updates only touch
+    the rows of the affected files. Writes are buffered and flushed as one fragment per `flush_size` documents.
+    """
+
+    def __init__(self, path, flush_size=256):
+        self.path = path
+        self.flush_size = flush_size
+        self._pending = []
+        self._dataset = lance.dataset(path) if os.path.exists(path) else None
+
+    @property
+    def exists(self):
+        return self._dataset is not None
+
+    def __len__(self):
+        return self._dataset.count_rows() if self._dataset is not None else 0
+
+    def add(self, file_path, documents):
+        for doc in documents:
+            self._pending.append({
+                "doc_id": doc.doc_id,
+                "file_path": file_path,
+                "text": doc.text,
+                "metadata": json.dumps(doc.metadata, default=str),
+                "excluded_embed_metadata_keys": doc.excluded_embed_metadata_keys,
+                "excluded_llm_metadata_keys": doc.excluded_llm_metadata_keys,
+            })
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def delete(self, file_paths):
+        if self._dataset is None or not file_paths:
+            return
+        for predicate in _in_filters("file_path", file_paths):
+            self._dataset.delete(predicate)
+
+    def flush(self):
+        if not self._pending:
+            return
+        table = pa.Table.from_pylist(self._pending, schema=SCHEMA)
+        self._dataset = lance.write_dataset(table, self.path, schema=SCHEMA,
+                                            mode="append" if self._dataset is not None else "create")
+        self._pending = []
+
+    def compact(self):
+        """Merge the small fragments left behind by many per-file updates."""
+        if self._dataset is not None:
+            self._dataset.optimize.compact_files()
+
+    def iter_batches(self, batch_size=64, file_paths=None):
+        """
+        Yield lists of at most `batch_size` documents, optionally only those from `file_paths`.
+        """
+        self.flush()
+        if self._dataset is None:
+            return
+        if file_paths is None:
+            filters = [None]
+        elif not file_paths:
+            return
+        else:
+            filters = _in_filters("file_path", file_paths)
+        for predicate in filters:
+            for batch in self._dataset.to_batches(batch_size=batch_size, filter=predicate):
+                yield [
+                    Document(id_=row["doc_id"], text=row["text"], metadata=json.loads(row["metadata"]),
+                             excluded_embed_metadata_keys=row["excluded_embed_metadata_keys"],
+                             excluded_llm_metadata_keys=row["excluded_llm_metadata_keys"])
+                    for row in batch.to_pylist()
+                ]
+
+    def iter_documents(self, file_paths=None):
+        for batch in self.iter_batches(file_paths=file_paths):
+            yield from batch
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from typing import Any, List
+
+import lancedb
+import pyarrow as pa
+
+# one cache shared by every ingestion entry point on this machine
+DEFAULT_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", os.path.expanduser("~/.cache/embedding_cache"))
+
+SCHEMA = pa.schema([
+    pa.field("key", pa.string()),
+    pa.field("model_id", pa.string()),
+    pa.field("vector", pa.list_(pa.float32())),
+    pa.field("last_used", pa.float64()),
+])
+
+# keep IN (...) filters to a reasonable size
+MAX_FILTER_VALUES = 500
+
+
+def normalize_text(text):
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def cache_key(model_id, dim, text, kind="document"):
+    """
+    Content address of an embedding. `kind` separates document and query embeddings, which differ for models that
+    add an instruction prefix to queries.
+    """
+    payload = "\0".join([model_id, str(dim or ""), kind, normalize_text(text)])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache in a local LanceDB table, keyed by (model id, dimension, normalized text hash).
+
+    Hits are only marked as used in memory and written back on `flush`, which also evicts the least recently used
+    entries beyond `max_entries`, compacts the table and refreshes the index on `key`.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, table_name="embeddings", max_entries=2_000_000):
+        self.max_entries = max_entries
+        self.db = lancedb.connect(path)
+        if table_name in self.db.table_names():
+            self.table = self.db.open_table(table_name)
+        else:
+            self.table = self.db.create_table(table_name, schema=SCHEMA, exist_ok=True)
+        self.lock = threading.Lock()
+        self.touched = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        """Return {key: vector} for the keys found in the cache."""
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        for i in range(0, len(keys), MAX_FILTER_VALUES):
+            batch = keys[i:i + MAX_FILTER_VALUES]
+            in_list = ", ".join(f"'{key}'" for key in batch)
+            rows = (self.table.search().where(f"key IN ({in_list})").select(["key", "vector"])
+                    .limit(len(batch)).to_list())
+            found.update((row["key"], row["vector"]) for row in rows)
+        with self.lock:
+            self.touched.update(found)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, model_id, items):
+        """Store (key, vector) pairs."""
+        if not items:
+            return
+        now = time.time()
+        rows = [{"key": key, "model_id": model_id, "vector": [float(v) for v in vector], "last_used": now}
+                for key, vector in items]
+        with self.lock:
+            (self.table.merge_insert("key").when_matched_update_all().when_not_matched_insert_all()
+             .execute(pa.Table.from_pylist(rows, schema=SCHEMA)))
+
+    def flush(self):
+        """Write back usage times, evict beyond `max_entries`, then compact and index the table."""
+        with self.lock:
+            touched, self.touched = list(self.touched), set()
+            now = time.time()
+            for i in range(0, len(touched), MAX_FILTER_VALUES):
+                in_list = ", ".join(f"'{key}'" for key in touched[i:i + MAX_FILTER_VALUES])
+                self.table.update(where=f"key IN ({in_list})", values={"last_used": now})
+
+            excess = self.table.count_rows() - self.max_entries
+            if excess > 0:
+                # by key, a cut-off on last_used would also delete every entry tied with the oldest one kept
+                rows = self.table.search().select(["key", "last_used"]).limit(None).to_arrow()
+                oldest = [key for _, key in sorted(zip(rows.column("last_used").to_pylist(),
+                                                       rows.column("key").to_pylist()))[:excess]]
+                for i in range(0, len(oldest), MAX_FILTER_VALUES):
+                    in_list = ", ".join(f"'{key}'" for key in oldest[i:i + MAX_FILTER_VALUES])
+                    self.table.delete(f"key IN ({in_list})")
+
+            if self.table.count_rows():
+                self.table.optimize()
+                self.table.create_scalar_index("key", replace=True)
+        print(f"Embedding cache: {self.hits} hits, {self.misses} misses.")
+
+    def embed(self, model_id, dim, texts, embed_fn, kind="document"):
+        """Embed `texts`, calling `embed_fn` (a batch function) only for the texts not in the cache."""
+        keys = [cache_key(model_id, dim, text, kind) for text in texts]
+        found = self.get_many(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = embed_fn(list(missing.values()))
+            computed = list(zip(missing.keys(), vectors))
+            self.put_many(model_id, computed)
+            found.update(computed)
+        return [list(found[key]) for key in keys]
+
+
+def _model_id(model):
+    for attr in ("model_id", "model_name", "model"):
+        value = getattr(model, attr, None)
+        if isinstance(value, str) and value:
+            return value
+    return type(model).__name__
+
+
+def _model_dim(model):
+    dim = getattr(model, "truncate_dim", None) or getattr(model, "dimensions", None)
+    if dim is None:
+        # Titan v2 through langchain_aws BedrockEmbeddings
+        dim = (getattr(model, "model_kwargs", None) or {}).get("dimensions")
+    return dim
+
+
+try:
+    from langchain_core.embeddings import Embeddings
+except ImportError:
+    Embeddings = None
+
+if Embeddings is not None:
+    class CachedEmbeddings(Embeddings):
+        """A LangChain `Embeddings` (e.g. BedrockEmbeddings, OllamaEmbeddings) backed by an `EmbeddingCache`."""
+
+        def __init__(self, embeddings, cache=None, dim=None):
+            self.embeddings = embeddings
+            self.cache = cache or EmbeddingCache()
+            self.model_id = _model_id(embeddings)
+            self.dim = dim or _model_dim(embeddings)
+
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            return self.cache.embed(self.model_id, self.dim, texts, self.embeddings.embed_documents)
+
+        def embed_query(self, text: str) -> List[float]:
+            return self.cache.embed(self.model_id, self.dim, [text],
+                                    lambda texts: [self.embeddings.embed_query(texts[0])], kind="query")[0]
+
+try:
+    from llama_index.core.base.embeddings.base import BaseEmbedding
+    from pydantic import PrivateAttr
+except ImportError:
+    BaseEmbedding = None
+
+if BaseEmbedding is not None:
+    class CachedLlamaEmbedding(BaseEmbedding):
+        """A llama-index embedding (e.g. HuggingFaceEmbedding) backed by an `EmbeddingCache`."""
+
+        _embed_model: Any = PrivateAttr()
+        _cache: Any = PrivateAttr()
+        _dim: Any = PrivateAttr()
+
+        def __init__(self, embed_model, cache=None, dim=None, **kwargs):
+            super().__init__(model_name=_model_id(embed_model), embed_batch_size=embed_model.embed_batch_size,
+                             **kwargs)
+            self._embed_model = embed_model
+            self._cache = cache or EmbeddingCache()
+            self._dim = dim or _model_dim(embed_model)
+
+        @property
+        def cache(self):
+            return self._cache
+
+        def _get_query_embedding(self, query: str) -> List[float]:
+            return self._cache.embed(self.model_name, self._dim, [query],
+                                     lambda texts: [self._embed_model.get_query_embedding(texts[0])],
+                                     kind="query")[0]
+
+        async def _aget_query_embedding(self, query: str) -> List[float]:
+            return self._get_query_embedding(query)
+
+        def _get_text_embedding(self, text: str) -> List[float]:
+            return self._get_text_embeddings([text])[0]
+
+        def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+            return self._cache.embed(self.model_name, self._dim, texts,
+                                     self._embed_model.get_text_embedding_batch)
@@ -8,6 +8,8 @@ from llama_index.vector_stores.lancedb import LanceDBVectorStore
 from llama_index.llms.openai import OpenAI
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
+from embedding_cache import CachedLlamaEmbedding, EmbeddingCache
+
 
 def get_doc_from_url(url):
     """
@@ -24,15 +26,21 @@ def build_RAG(
     This function sets embedding model, llm and vector store to be used for creating RAG index.
     """
 
-    Settings.embed_model = HuggingFaceEmbedding(
-        model_name=matryoshka_embedding_model,
-        truncate_dim=int(matryoshka_embedding_size),
+    embedding_cache = EmbeddingCache()
+    Settings.embed_model = CachedLlamaEmbedding(
+        HuggingFaceEmbedding(
+            model_name=matryoshka_embedding_model,
+            truncate_dim=int(matryoshka_embedding_size),
+        ),
+        cache=embedding_cache,
+        dim=int(matryoshka_embedding_size),
     )
     Settings.llm = OpenAI()  # This will now use the API key from the environment
     documents = get_doc_from_url(url)
     vector_store = LanceDBVectorStore(uri=db_uri)
     storage_context = StorageContext.from_defaults(vector_store=vector_store)
     index = VectorStoreIndex.from_documents(documents, storage_context=storage_context)
+    embedding_cache.flush()
     query_engine = index.as_chat_engine()
 
     return query_engine
@@ -0,0 +1,177 @@
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: int
+    parent_id: Optional[int]
+    start: float
+    end: Optional[float] = None
+    attributes: Dict[str, object] = field(default_factory=dict)
+    # wall clock start, for correlating with logs
+    timestamp: float = field(default_factory=time.time)
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self):
+        return {"type": "span", "name": self.name, "span_id": self.span_id, "parent_id": self.parent_id,
+                "timestamp": self.timestamp, "duration_seconds": self.duration, "attributes": self.attributes}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in key) + "}"
+
+
+class Counter:
+    def __init__(self, name, help=""):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), 0)
+
+    def samples(self):
+        for key, value in list(self.values.items()):
+            yield self.name, key, value
+
+    def prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{name}{_format_labels(key)} {value}" for name, key, value in self.samples()]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help="", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (value <= bound) for c, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        for key, (counts, total, count) in list(self.values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", key + (("le", bound),), bucket_count
+            yield f"{self.name}_bucket", key + (("le", "+Inf"),), count
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+    def prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        lines += [f"{name}{_format_labels(key)} {value}" for name, key, value in self.samples()]
+        return lines
+
+
+class MetricsRegistry:
+    """Holds the finished spans and the named counters and histograms of one process."""
+
+    def __init__(self):
+        self.spans = []
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help=""):
+        with self.lock:
+            return self.metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS):
+        with self.lock:
+            return self.metrics.setdefault(name, Histogram(name, help, buckets))
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time a block as a child of the enclosing span (also across asyncio tasks and `asyncio.to_thread`)."""
+        parent = _current_span.get()
+        current = Span(name, next(_span_ids), parent.span_id if parent else None, time.perf_counter(),
+                       attributes=attributes)
+        token = _current_span.set(current)
+        try:
+            yield current
+        except BaseException as e:
+            current.attributes["error"] = type(e).__name__
+            raise
+        finally:
+            current.end = time.perf_counter()
+            _current_span.reset(token)
+            with self.lock:
+                self.spans.append(current)
+            self.histogram("span_duration_seconds", "Duration of instrumented stages").observe(
+                current.duration, span=name)
+
+    def export_jsonl(self, path):
+        """Append the finished spans and the current metric samples to `path`, one JSON object per line."""
+        with self.lock:
+            spans, self.spans = self.spans, []
+        with open(path, "a", encoding="utf-8") as f:
+            for s in spans:
+                f.write(json.dumps(s.to_dict(), default=str) + "\n")
+            now = time.time()
+            for metric in list(self.metrics.values()):
+                for name, key, value in metric.samples():
+                    f.write(json.dumps({"type": "metric", "name": name, "labels": dict(key), "value": value,
+                                        "timestamp": now}, default=str) + "\n")
+
+    def prometheus_text(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.prometheus()
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the Prometheus text format atomically, e.g. for the node_exporter textfile collector."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = MetricsRegistry()
+
+
+def span(name, **attributes):
+    return REGISTRY.span(name, **attributes)
+
+
+def counter(name, help=""):
+    return REGISTRY.counter(name, help)
+
+
+def histogram(name, help="", buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, help, buckets)
@@ -130,26 +130,14 @@ def assume_limited_role(role_name, region='us-east-1'):
     """
         Assume a role with limited permissions to interact with the S3 bucket.
 
+    Prefer a long-lived `RoleCredentialProvider`, which refreshes the credentials before they expire.
+
     :return: Temporary credentials for the assumed role.
     """
-    sts_client = boto3.client('sts', region_name=region)
-    caller_identity = sts_client.get_caller_identity()
-    account_id = caller_identity.get('Account')
-
-    try:
-        assumed_role_object = sts_client.assume_role(
-            RoleArn=f'arn:aws:iam::{account_id}:role/{role_name}',
-            RoleSessionName='LanceDBSession'
-        )
-        credentials = assumed_role_object['Credentials']
-        print("Assumed role and obtained temporary credentials.")
-    except ClientError as e:
-        print(f"Error assuming role: {e}")
-        raise
-
-    return credentials
-
+    # imported here so the rest of the script runs without the Lambda's sources on the path
+    from serverless_rag_with_lambda_lance_bedrock.rag_lambda.python.credentials import RoleCredentialProvider
 
+    return RoleCredentialProvider(role_name, region=region, background=False).get()
 
 
 def destroy(bucket_name, policy_name, role_name, region='us-east-1'):
@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+from llama_index.core.ingestion import IngestionPipeline
+
+from metrics import counter, histogram, span
+
+# marks the end of a queue
+_DONE = object()
+
+EMBEDDING_RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _payload_bytes(nodes):
+    return sum(4 * len(node.embedding or []) + len(node.get_content().encode('utf-8')) for node in nodes)
+
+
+async def _load(document_batches, out_queue, num_workers):
+    iterator = iter(document_batches)
+    while True:
+        # the store reads from disk, keep it off the event loop
+        documents = await asyncio.to_thread(next, iterator, None)
+        if documents is None:
+            break
+        await out_queue.put(documents)
+    for _ in range(num_workers):
+        await out_queue.put(_DONE)
+
+
+async def _transform(pipeline, in_queue, out_queue, stats):
+    while True:
+        documents = await in_queue.get()
+        if documents is _DONE:
+            await out_queue.put(_DONE)
+            return
+        # chunking and embedding are CPU/GPU bound, run them in a worker thread
+        start = time.perf_counter()
+        nodes = await asyncio.to_thread(pipeline.run, documents=documents)
+        elapsed = time.perf_counter() - start
+        stats["documents"] += len(documents)
+        counter("chunks_produced_total", "Nodes produced by chunking").inc(len(nodes))
+        if nodes and elapsed > 0:
+            histogram("embeddings_per_second", "Chunk + embed throughput per batch",
+                      buckets=EMBEDDING_RATE_BUCKETS).observe(len(nodes) / elapsed)
+        await out_queue.put(nodes)
+
+
+async def _write(vector_store, in_queue, num_workers, stats):
+    remaining = num_workers
+    while remaining:
+        nodes = await in_queue.get()
+        if nodes is _DONE:
+            remaining -= 1
+            continue
+        if nodes:
+            # a callable returns the store to use for this batch, e.g. one reconnected with refreshed credentials
+            store = vector_store() if callable(vector_store) else vector_store
+            with span("vector_store.add", nodes=len(nodes)):
+                await asyncio.to_thread(store.add, nodes)
+            counter("lancedb_bytes_written_total",
+                    "Approximate bytes (vectors + text) written to the LanceDB table").inc(_payload_bytes(nodes))
+        stats["nodes"] += len(nodes)
+
+
+async def stream_ingest(document_batches, transformations, embed_model, vector_store, num_workers=2,
+                        queue_depth=4):
+    """
+    Load, chunk + embed, and write document batches as overlapping pipeline stages.
+
+    `document_batches` is any iterable of document lists (e.g. `DocumentStore.iter_batches`). The queues between
+    the stages hold at most `queue_depth` batches, so memory is bounded by the batch size rather than the corpus,
+    and writes to the (S3 backed) table happen while the next batches are being embedded.
+
+    :return: a dict with the number of documents and nodes ingested
+    """
+    # the default in-memory cache would keep every embedded batch (and is shared by the worker threads); the
+    # embedding cache already avoids re-embedding unchanged text
+    pipeline = IngestionPipeline(transformations=list(transformations) + [embed_model], disable_cache=True)
+    document_queue = asyncio.Queue(maxsize=queue_depth)
+    node_queue = asyncio.Queue(maxsize=queue_depth)
+    stats = {"documents": 0, "nodes": 0}
+
+    # tasks created inside the span record their spans as its children
+    with span("stream_ingest", num_workers=num_workers, queue_depth=queue_depth):
+        tasks = [asyncio.create_task(_load(document_batches, document_queue, num_workers))]
+        tasks += [asyncio.create_task(_transform(pipeline, document_queue, node_queue, stats))
+                  for _ in range(num_workers)]
+        tasks.append(asyncio.create_task(_write(vector_store, node_queue, num_workers, stats)))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+    return stats
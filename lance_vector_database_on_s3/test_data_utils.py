@@ -0,0 +1,56 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from data_utils import download_pdf
+
+CONTENT = bytes(range(256)) * 4096
+
+
+class IgnoresRangeHandler(BaseHTTPRequestHandler):
+    """Always answers 200 with the whole file, like servers without Range support."""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(CONTENT)))
+        self.end_headers()
+        self.wfile.write(CONTENT)
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeHandler(IgnoresRangeHandler):
+    def do_GET(self):
+        offset = int(self.headers["Range"][len("bytes="):-1]) if self.headers.get("Range") else 0
+        body = CONTENT[offset:]
+        self.send_response(206 if offset else 200)
+        if offset:
+            self.send_header("Content-Range", f"bytes {offset}-{len(CONTENT) - 1}/{len(CONTENT)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(params=[IgnoresRangeHandler, RangeHandler])
+def server_url(request):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), request.param)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/{{id}}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_resumes_partial_file(tmp_path, server_url):
+    filename = str(tmp_path / "document.pdf")
+    with open(filename + ".part", "wb") as part:
+        part.write(CONTENT[:1000])
+
+    assert download_pdf("doc", filename, url_template=server_url, attempts=1)
+
+    with open(filename, "rb") as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(filename + ".part")
@@ -1,18 +1,36 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import hashlib
 import os
+import sys
 
-import boto3
 from langchain_text_splitters import CharacterTextSplitter
 from langchain_community.vectorstores import LanceDB
 import lancedb as ldb
-from langchain_aws import BedrockEmbeddings
 from langchain_community.document_loaders.pdf import PyPDFDirectoryLoader
 
+# the embedding cache and Titan client are shared with the rest of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+from s3_sync import sync_dataset_to_s3
+from vector_index import ensure_fts_index, ensure_vector_index
+from lance_vector_database_on_s3.embedding_cache import CachedEmbeddings
+# the same concurrent Titan client the Lambda uses for queries
+from serverless_rag_with_lambda_lance_bedrock.rag_lambda.python.titan_embeddings import TitanEmbeddings
 
-import pyarrow as pa
-embeddings = BedrockEmbeddings(model_id="amazon.titan-embed-text-v2:0", region_name="us-west-2")
+embeddings = CachedEmbeddings(TitanEmbeddings(model_id="amazon.titan-embed-text-v2:0", region_name="us-west-2"))
+
+# the table is built once locally and its files are then copied to the bucket the Lambda reads from
+local_db_uri = 'tmp/embeddings'
+table_name = "doc_table"
+s3_bucket_name = sys.argv[1] if len(sys.argv) > 1 else os.getenv(
+    "s3BucketName", "streaming-rag-on-lambda-documents-us-west-2-736682772784")
+
+
+def chunk_id(doc):
+    """A stable id, so a rerun can tell which chunks are already in the table."""
+    key = f"{doc.metadata.get('source')}\0{doc.metadata.get('page')}\0{doc.page_content}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
 
 
 # we split the data into chunks of 1,000 characters, with an overlap
@@ -20,32 +38,41 @@ embeddings = BedrockEmbeddings(model_id="amazon.titan-embed-text-v2:0", region_n
 # and contain the context of the information between chunks
 text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
 
-db = ldb.connect('tmp/embeddings')
-
-schema = pa.schema(
-  [
-      pa.field("vector", pa.list_(pa.float32(), 1536)), # document vector with 1.5k dimensions (TitanEmbedding)
-      pa.field("text", pa.string()), # langchain requires it
-      pa.field("id", pa.string()) # langchain requires it
-  ])
-
-tbl = db.create_table("doc_table", schema=schema, exist_ok=True)
-
 # load the document as before
 
 loader = PyPDFDirectoryLoader("./docs/")
 
 docs = loader.load()
 docs = text_splitter.split_documents(docs)
-
-
-# Update LanceDB storage configuration
-LanceDB.from_documents(docs, embeddings, uri='tmp/embeddings/doc_table/', table_name="doc_table")
-
-s3_bucket_name = "streaming-rag-on-lambda-documents-us-west-2-736682772784"
-LanceDB.from_documents(docs, embeddings, uri='s3://' + s3_bucket_name + '/doc_table/', table_name="doc_table")
-
-# sync folder with S3
-#boto3.client('s3').upload_file('tmp/embeddings', 's3://' + s3_bucket_name + '/doc_table/' , 'embeddings.parquet')
-
-print("woop woop")
\ No newline at end of file
+ids = [chunk_id(doc) for doc in docs]
+
+db = ldb.connect(local_db_uri)
+existing_ids = set()
+if table_name in db.table_names():
+    tbl = db.open_table(table_name)
+    existing_ids = set(tbl.search().select(["id"]).limit(None).to_arrow().column("id").to_pylist())
+    # chunks of removed or changed documents
+    stale_ids = existing_ids - set(ids)
+    if stale_ids:
+        tbl.delete("id IN (" + ", ".join(f"'{stale_id}'" for stale_id in stale_ids) + ")")
+
+# append only the new chunks, so a rerun only adds new fragments
+new_docs = [(doc, doc_id) for doc, doc_id in zip(docs, ids) if doc_id not in existing_ids]
+print(f"{len(new_docs)} new chunks, {len(docs) - len(new_docs)} already in the table.")
+if new_docs:
+    vector_store = LanceDB(connection=db, embedding=embeddings, table_name=table_name, mode="append")
+    vector_store.add_documents([doc for doc, _ in new_docs], ids=[doc_id for _, doc_id in new_docs])
+
+embeddings.cache.flush()
+
+# keep queries sublinear as the table grows; the index files are synced with the data
+if table_name in db.table_names():
+    tbl = db.open_table(table_name)
+    ensure_vector_index(tbl, index_type=os.getenv("vectorIndexType", "IVF_PQ"))
+    # keyword half of the Lambda's hybrid retrieval
+    ensure_fts_index(tbl)
+
+# publish with a file level sync, the Lambda opens s3://<bucket>/doc_table
+sync_dataset_to_s3(os.path.join(local_db_uri, f"{table_name}.lance"), s3_bucket_name, f"{table_name}.lance")
+
+print("woop woop")
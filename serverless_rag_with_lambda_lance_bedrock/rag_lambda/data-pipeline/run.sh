@@ -35,15 +35,9 @@ else
   echo "$documents"
 fi
 
-rm -rf /tmp/embeddings
-python3 ingest.py
-
-
 STACK_NAME=$1
 BUCKET_NAME=$(aws cloudformation describe-stacks --stack-name $STACK_NAME --query 'Stacks[0].Outputs[?OutputKey==`DocumentBucketName`].OutputValue' --output text)
 
-
-cp -r /tmp/embeddings ./
-
+# embeds new chunks into ./tmp/embeddings and uploads the new table files to s3://${BUCKET_NAME}
 echo "Exporting embeddings to s3://${BUCKET_NAME}"
-aws s3 sync ./embeddings s3://${BUCKET_NAME}
+python3 ingest.py "${BUCKET_NAME}"
@@ -0,0 +1,62 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+from serverless_rag_with_lambda_lance_bedrock.rag_lambda.python.local_mirror import LATEST_MANIFEST, is_manifest
+
+MB = 1024 * 1024
+
+# large fragments go up in parallel 16 MB parts
+DEFAULT_TRANSFER_CONFIG = TransferConfig(multipart_threshold=16 * MB, multipart_chunksize=16 * MB, max_concurrency=4)
+
+
+def list_remote_sizes(s3, bucket, prefix):
+    sizes = {}
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            sizes[obj["Key"]] = obj["Size"]
+    return sizes
+
+
+def sync_dataset_to_s3(local_dir, bucket, prefix, s3=None, transfer_config=DEFAULT_TRANSFER_CONFIG, max_workers=8):
+    """
+    Upload the files of a local Lance dataset that aren't on S3 yet.
+
+    Lance never modifies a file once written (data fragments, deletion files and indices get unique names and every
+    version gets a new manifest), so a file already on S3 with the same size is skipped. The one exception is
+    `_latest.manifest`, which is overwritten on every commit and always uploaded. Manifests are uploaded after
+    everything else so a reader never sees a version whose files are still missing.
+
+    :param local_dir: the dataset directory, e.g. tmp/embeddings/doc_table.lance
+    :param prefix: the key of the dataset directory on S3, e.g. doc_table.lance/
+    :return: the uploaded keys
+    """
+    s3 = s3 or boto3.client("s3")
+    prefix = prefix.rstrip("/") + "/"
+    remote = list_remote_sizes(s3, bucket, prefix)
+
+    files, manifests = [], []
+    for root, _, names in os.walk(local_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, local_dir).replace(os.sep, "/")
+            key = prefix + rel_path
+            if rel_path != LATEST_MANIFEST and remote.get(key) == os.path.getsize(path):
+                continue
+            (manifests if is_manifest(rel_path) else files).append((path, key))
+
+    def upload(item):
+        path, key = item
+        s3.upload_file(path, bucket, key, Config=transfer_config)
+        return key
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        uploaded = list(executor.map(upload, files))
+    uploaded += [upload(item) for item in sorted(manifests, key=lambda item: item[1])]
+    print(f"Uploaded {len(uploaded)} files to s3://{bucket}/{prefix} ({len(remote)} already there).")
+    return uploaded
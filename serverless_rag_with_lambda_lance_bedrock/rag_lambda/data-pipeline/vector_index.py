@@ -0,0 +1,92 @@
+import math
+
+# PQ needs enough rows to train its codebooks; below this a brute force scan is fast anyway
+MIN_ROWS_FOR_INDEX = 5000
+# rebuild rather than incrementally update once this share of the rows isn't covered by the index
+REBUILD_UNINDEXED_FRACTION = 0.2
+
+
+def partition_count(num_rows):
+    """About sqrt(rows) IVF partitions, so each holds a few thousand rows at scale."""
+    return max(1, min(4096, int(math.sqrt(num_rows))))
+
+
+def sub_vector_count(dim):
+    """PQ sub-vectors of 16 dimensions (8 for small vectors), dividing `dim` evenly."""
+    target = 16 if dim >= 256 else 8
+    count = max(1, dim // target)
+    while dim % count:
+        count -= 1
+    return count
+
+
+def _vector_index(table, column):
+    for index in table.list_indices():
+        if column in index.columns and index.index_type.upper().startswith("IVF"):
+            return index
+    return None
+
+
+def index_coverage(table, column="vector"):
+    """
+    How much of `table` the vector index on `column` covers. Rows added after the index was built are searched
+    by brute force until the index is updated, so a low coverage means slower queries.
+    """
+    index = _vector_index(table, column)
+    num_rows = table.count_rows()
+    if index is None:
+        return {"index": None, "indexed_rows": 0, "unindexed_rows": num_rows, "coverage": 0.0}
+    stats = table.index_stats(index.name)
+    indexed, unindexed = stats.num_indexed_rows, stats.num_unindexed_rows
+    return {"index": index.name, "index_type": stats.index_type, "indexed_rows": indexed,
+            "unindexed_rows": unindexed, "coverage": indexed / max(1, indexed + unindexed)}
+
+
+def ensure_vector_index(table, column="vector", index_type="IVF_PQ", metric="l2", min_rows=MIN_ROWS_FOR_INDEX):
+    """
+    Build or update the ANN index on `column` after an ingest.
+
+    A missing index is built once the table has `min_rows` rows, with the partition and sub-vector counts derived
+    from the row count and dimension. New rows are added to an existing index incrementally (`optimize`), unless
+    more than `REBUILD_UNINDEXED_FRACTION` of the table is unindexed, in which case the partitions are retrained.
+    `index_type` is "IVF_PQ" (smallest, needs `refine_factor` for exact ranking) or "IVF_HNSW_SQ" (better recall
+    for the same `nprobes`, larger).
+
+    :return: the coverage of the index afterwards, see `index_coverage`
+    """
+    num_rows = table.count_rows()
+    coverage = index_coverage(table, column)
+    if num_rows < min_rows:
+        print(f"{num_rows} rows, not indexing '{column}' below {min_rows} rows.")
+        return coverage
+
+    if coverage["index"] is not None and coverage["unindexed_rows"] <= REBUILD_UNINDEXED_FRACTION * num_rows:
+        if coverage["unindexed_rows"]:
+            table.optimize()
+    else:
+        dim = len(table.search().select([column]).limit(1).to_list()[0][column])
+        options = {"num_partitions": partition_count(num_rows)}
+        if index_type.upper() == "IVF_PQ":
+            options["num_sub_vectors"] = sub_vector_count(dim)
+        print(f"Building {index_type} index on '{column}' ({num_rows} rows, {dim} dimensions, {options}).")
+        table.create_index(metric=metric, vector_column_name=column, index_type=index_type, replace=True,
+                           **options)
+
+    coverage = index_coverage(table, column)
+    print(f"Index '{coverage['index']}' covers {coverage['indexed_rows']} rows, "
+          f"{coverage['unindexed_rows']} unindexed ({coverage['coverage']:.1%}).")
+    return coverage
+
+
+def ensure_fts_index(table, column="text"):
+    """
+    Build the full text (BM25) index on `column` used by keyword and hybrid search, or rebuild it when rows were
+    added since. Like the vector index, it is stored with the dataset and synced to S3 with it.
+    """
+    for index in table.list_indices():
+        if column in index.columns and index.index_type.upper() in ("FTS", "INVERTED"):
+            if not table.index_stats(index.name).num_unindexed_rows:
+                return
+            break
+    print(f"Building full text index on '{column}'.")
+    table.create_fts_index(column, use_tantivy=False, replace=True)
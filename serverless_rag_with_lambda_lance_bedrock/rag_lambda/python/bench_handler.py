@@ -0,0 +1,189 @@
+"""
+Offline latency benchmark of index.handler.
+
+Runs the handler against a local LanceDB dataset with stand-ins for STS and Bedrock (embeddings and converse)
+whose latencies are configurable, so changes to the chain can be compared before deploying:
+
+    python bench_handler.py --requests 200 --concurrency 16 --embed-latency 0.05 --ttft 0.4
+
+Reports p50/p95/p99 time to first byte and total latency, throughput, and the median of each stage recorded by
+the handler's telemetry.
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import random
+import tempfile
+import time
+from typing import Any
+
+import lancedb
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+import index
+
+WORDS = ("bedrock lambda lance vector index model claude titan embedding query stream latency token bucket "
+         "region table version cache retrieval context prompt answer health care insurance policy").split()
+
+
+class StubCredentials:
+    """Stands in for RoleCredentialProvider, a local dataset needs no STS call."""
+
+    generation = 1
+
+    async def astorage_options(self, **extra):
+        return {"aws_region": index.aws_region, "aws_access_key_id": "stub", "aws_secret_access_key": "stub",
+                "aws_session_token": "stub", **extra}
+
+
+class StubEmbeddings:
+    """Deterministic unit vectors after `latency` seconds, like a Titan call."""
+
+    def __init__(self, dimensions, latency):
+        self.model_id = "stub-embeddings"
+        self.dimensions = dimensions
+        self.latency = latency
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def embed_query(self, text):
+        time.sleep(self.latency)
+        return self._vector(text).tolist()
+
+
+class StubChatModel(BaseChatModel):
+    """Streams `tokens` words, the first after `first_token_latency` seconds, then one per `token_latency`."""
+
+    model_id: str = "stub-chat"
+    first_token_latency: float = 0.3
+    token_latency: float = 0.01
+    tokens: int = 50
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub-chat"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.first_token_latency + self.token_latency * (self.tokens - 1))
+        text = " ".join(random.choice(WORDS) for _ in range(self.tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        await asyncio.sleep(self.first_token_latency)
+        for i in range(self.tokens):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=random.choice(WORDS) + " "))
+
+
+class MockResponseStream:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_byte = None
+        self.ended = None
+        self.output = io.StringIO()
+
+    def write(self, data):
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter()
+        self.output.write(data)
+
+    def end(self):
+        self.ended = time.perf_counter()
+
+
+def build_dataset(path, documents, embeddings, table_name):
+    """A table with the columns the data-pipeline writes, plus the full text index hybrid retrieval uses."""
+    rows = []
+    for i in range(documents):
+        text = " ".join(random.choice(WORDS) for _ in range(150))
+        rows.append({"id": f"chunk-{i}", "text": text, "vector": embeddings._vector(text),
+                     "metadata": {"source": f"docs/doc-{i // 20}.pdf", "page": i % 20}})
+    table = lancedb.connect(path).create_table(table_name, rows, mode="overwrite")
+    table.create_fts_index("text", use_tantivy=False, replace=True)
+    return table
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else float("nan")
+
+
+async def run(args):
+    records = []
+    index.telemetry_sink = lambda line: records.append(json.loads(line))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    streams = []
+
+    async def request(i):
+        # unique questions, unless --repeat makes the query and answer caches part of the measurement
+        query = f"question {i % args.repeat if args.repeat else i}: " + " ".join(random.sample(WORDS, 5))
+        event = {"body": json.dumps({"query": query, "model": "stub-chat", "retrievalMode": args.retrieval_mode,
+                                     "streamingFormat": "fetch-event-source"}), "isBase64Encoded": False}
+        async with semaphore:
+            stream = MockResponseStream()
+            await index.handler(event, stream, None)
+            streams.append(stream)
+
+    # warm up, so the connection and table open aren't part of the percentiles
+    await request(-1)
+    streams.clear()
+    records.clear()
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*(request(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    return streams, records, elapsed
+
+
+def report(streams, records, elapsed):
+    ttfb = [(s.first_byte - s.started) * 1000 for s in streams if s.first_byte]
+    total = [(s.ended - s.started) * 1000 for s in streams if s.ended]
+    print(f"{len(streams)} requests in {elapsed:.2f}s, {len(streams) / elapsed:.1f} requests/s")
+    for name, values in (("TTFB ms", ttfb), ("total ms", total)):
+        print(f"{name:>10}: p50 {percentile(values, 50):8.1f}  p95 {percentile(values, 95):8.1f}  "
+              f"p99 {percentile(values, 99):8.1f}")
+    stages = sorted({name for record in records for name in record if name.endswith("Ms")})
+    for name in stages:
+        values = [record[name] for record in records if name in record]
+        print(f"{name:>20}: p50 {percentile(values, 50):8.1f}  p95 {percentile(values, 95):8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--documents", type=int, default=2000, help="rows in the local dataset")
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--embed-latency", type=float, default=0.03, help="seconds per query embedding")
+    parser.add_argument("--ttft", type=float, default=0.3, help="seconds to the first LLM token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="seconds between LLM tokens")
+    parser.add_argument("--tokens", type=int, default=50, help="tokens per answer")
+    parser.add_argument("--retrieval-mode", default="hybrid", choices=("hybrid", "vector"))
+    parser.add_argument("--repeat", type=int, default=0, help="cycle through this many distinct questions")
+    args = parser.parse_args()
+
+    embeddings = StubEmbeddings(args.dimensions, args.embed_latency)
+    with tempfile.TemporaryDirectory() as path:
+        build_dataset(path, args.documents, embeddings, index.lance_db_table)
+        index.lance_db_uri = path
+        index.resources.credentials = StubCredentials()
+        index.resources.embeddings = embeddings
+        index.resources.llms["stub-chat"] = StubChatModel(first_token_latency=args.ttft,
+                                                          token_latency=args.token_latency, tokens=args.tokens)
+        streams, records, elapsed = asyncio.run(run(args))
+    report(streams, records, elapsed)
+
+
+if __name__ == "__main__":
+    main()
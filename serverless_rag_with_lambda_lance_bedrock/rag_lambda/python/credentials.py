@@ -0,0 +1,112 @@
+import asyncio
+import threading
+from datetime import datetime, timedelta, timezone
+
+import boto3
+
+# the caller's account doesn't change during the life of a process
+_account_id = None
+_account_lock = threading.Lock()
+
+
+def get_account_id(sts_client):
+    global _account_id
+    with _account_lock:
+        if _account_id is None:
+            _account_id = sts_client.get_caller_identity().get('Account')
+        return _account_id
+
+
+class RoleCredentialProvider:
+    """
+    Temporary credentials for an assumed role, refreshed before they expire.
+
+    A background timer re-assumes the role `refresh_margin` before `Expiration`, so callers normally get cached
+    credentials without an STS round-trip. `get` also refreshes on its own if the timer hasn't run (e.g. a frozen
+    Lambda container). `generation` changes with every refresh, so holders of clients built from the credentials
+    (like a LanceDB connection) can tell when to rebuild them. Safe to use from several threads and from asyncio.
+    """
+
+    def __init__(self, role_name, region='us-west-2', session_name='LanceDBSession',
+                 refresh_margin=timedelta(minutes=10), background=True):
+        self.role_name = role_name
+        self.region = region
+        self.session_name = session_name
+        self.refresh_margin = refresh_margin
+        self.background = background
+        self.sts_client = boto3.client('sts', region_name=region)
+        self.generation = 0
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def _fresh(self, margin):
+        return (self._credentials is not None and
+                self._credentials['Expiration'] - margin > datetime.now(timezone.utc))
+
+    def _refresh(self):
+        account_id = get_account_id(self.sts_client)
+        try:
+            assumed_role_object = self.sts_client.assume_role(
+                RoleArn=f'arn:aws:iam::{account_id}:role/{self.role_name}',
+                RoleSessionName=self.session_name
+            )
+        except Exception as e:
+            print(f"Error assuming role: {e}")
+            raise
+        self._credentials = assumed_role_object['Credentials']
+        self.generation += 1
+        print("Assumed role and obtained temporary credentials.")
+        self._schedule((self._credentials['Expiration'] - self.refresh_margin
+                        - datetime.now(timezone.utc)).total_seconds())
+
+    def _schedule(self, delay):
+        if not self.background:
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(delay, 1.0), self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        with self._lock:
+            try:
+                self._refresh()
+            except Exception:
+                # the current credentials are still valid for a while, try again shortly
+                self._schedule(30)
+
+    def get(self):
+        """The current credentials dict (AccessKeyId, SecretAccessKey, SessionToken, Expiration)."""
+        with self._lock:
+            # half the margin, so a late timer doesn't make every caller block on STS
+            if not self._fresh(self.refresh_margin / 2):
+                self._refresh()
+            return self._credentials
+
+    async def aget(self):
+        if self._fresh(self.refresh_margin / 2):
+            return self._credentials
+        return await asyncio.to_thread(self.get)
+
+    def _storage_options(self, credentials, extra):
+        return {
+            "aws_region": self.region,
+            "aws_access_key_id": credentials['AccessKeyId'],
+            "aws_secret_access_key": credentials['SecretAccessKey'],
+            "aws_session_token": credentials['SessionToken'],
+            **extra,
+        }
+
+    def storage_options(self, **extra):
+        """LanceDB `storage_options` with the current credentials."""
+        return self._storage_options(self.get(), extra)
+
+    async def astorage_options(self, **extra):
+        return self._storage_options(await self.aget(), extra)
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
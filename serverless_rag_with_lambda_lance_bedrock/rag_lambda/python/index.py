@@ -1,14 +1,25 @@
+import asyncio
 import json
 import os
+import shutil
+from contextlib import nullcontext
+from datetime import timedelta
 
 import boto3
 from lancedb import connect_async
-from langchain_aws import BedrockEmbeddings, ChatBedrockConverse
-from langchain_community.vectorstores import LanceDB
+from langchain_aws import ChatBedrockConverse
+from langchain_core.documents import Document
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.prompts.base import format_document
 
+from credentials import RoleCredentialProvider
+from local_mirror import ReadThroughCache
+from query_cache import AnswerCache, QueryCache, context_fingerprint
+from retrieval import estimate_tokens, pack_context, reciprocal_rank_fusion
+from telemetry import RequestTelemetry
+from titan_embeddings import TitanEmbeddings
+
 os.environ["s3BucketName"] = "streaming-rag-on-lambda-documents-"
 os.environ["lanceDbTable"] = "doc_table"
 os.environ["region"] = "us-west-2"
@@ -17,38 +28,231 @@ os.environ["region"] = "us-west-2"
 lance_db_src = os.getenv('s3BucketName')
 lance_db_table = os.getenv('lanceDbTable')
 aws_region = os.getenv('region')
+# a local path reads a local dataset, e.g. for benchmarks
+lance_db_uri = os.getenv('lanceDbUri', f's3://{lance_db_src}/')
+# repeated questions reuse their embedding and, until the table changes, their retrieved documents
+query_cache_ttl = int(os.getenv('queryCacheTtl', '900'))
+query_cache_size = int(os.getenv('queryCacheSize', '1024'))
+# e.g. /tmp/query_cache.sqlite to add a file backed tier
+query_cache_path = os.getenv('queryCachePath')
+# near duplicate questions (cosine similarity of their embeddings) with the same context get the cached answer
+answer_cache_threshold = float(os.getenv('answerCacheThreshold', '0.95'))
+answer_cache_size = int(os.getenv('answerCacheSize', '512'))
+
+# estimated tokens of retrieved context in the prompt
+context_token_budget = int(os.getenv('contextTokenBudget', '1500'))
+# number of documents retrieved per question
+RETRIEVAL_K = 4
+# ANN search defaults, a request can override them: more partitions probed and a larger refine factor (re-ranking
+# k * refine_factor candidates by exact distance) trade latency for recall
+default_nprobes = int(os.getenv('nprobes', '20'))
+default_refine_factor = int(os.getenv('refineFactor', '0')) or None
+# "hybrid" fuses full text (BM25) and vector search results, "vector" only runs the vector search
+default_retrieval_mode = os.getenv('retrievalMode', 'hybrid')
+# each search of a hybrid query returns this many times k candidates for the fusion
+HYBRID_CANDIDATES = 3
+# how often the open table looks for a newer version on S3
+TABLE_VERSION_CHECK_INTERVAL = timedelta(seconds=30)
+# blocks of the table read from S3 are kept on local disk, set localCacheBytes to 0 to always read from S3
+local_cache_dir = os.getenv('localCacheDir', '/tmp/lance_cache')
+# by default three quarters of the ephemeral storage (512 MB unless configured), leaving room for the query cache
+# file and blocks being written
+local_cache_bytes = int(os.getenv('localCacheBytes', str(
+    shutil.disk_usage(os.path.dirname(local_cache_dir)).total * 3 // 4
+    if os.path.isdir(os.path.dirname(local_cache_dir)) else 384 * 1024 * 1024)))
 
 
-def format_documents_as_string(docs):
+def format_documents_as_string(docs, token_budget=None):
+    """The retrieved documents as prompt context, deduplicated and packed into `token_budget` tokens."""
     prompt = PromptTemplate.from_template("Page {page}: {page_content}")
+    docs = pack_context(docs, token_budget or context_token_budget)
     return "\n".join(format_document(doc, prompt) for doc in docs)
 
 
-async def run_chain(query, model, streaming_format, response_stream):
-    credentials = assume_limited_role("document-processor-role", region=aws_region)
+class LambdaResources:
+    """
+    Clients that live as long as the (warm) container: assumed role credentials, the LanceDB connection and table,
+    the embeddings, the query cache and one chat model per model id. Only the first invocation of a container,
+    and the first one after the credentials were refreshed, pays for STS and connecting to S3. The table is read
+    through a cache of up to `localCacheBytes` on local disk, so warm invocations read its hot blocks locally.
+    """
+
+    def __init__(self):
+        self.credentials = RoleCredentialProvider("document-processor-role", region=aws_region)
+        self.credentials_generation = None
+        self.db = None
+        self.db_uri = None
+        self.table = None
+        self.s3 = None
+        self.cache = ReadThroughCache(local_cache_dir, local_cache_bytes) if local_cache_bytes else None
+        self.embeddings = None
+        self.llms = {}
+        self.query_cache = QueryCache(query_cache_size, query_cache_ttl, query_cache_path)
+        self.answer_cache = AnswerCache(answer_cache_size, query_cache_ttl, answer_cache_threshold)
+        self._lock = None
+        self._loop = None
+
+    async def refresh(self, telemetry=None):
+        # each invocation may run in a new event loop, and an asyncio.Lock belongs to one loop
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._lock, self._loop = asyncio.Lock(), loop
+        stage = telemetry.stage if telemetry else lambda name: nullcontext()
+
+        async with self._lock:
+            with stage('Credentials'):
+                storage_options = await self.credentials.astorage_options()
+            if self.credentials.generation != self.credentials_generation:
+                # the connection was opened with the previous credentials
+                self.credentials_generation = self.credentials.generation
+                self.db = None
+                self.s3 = boto3.client('s3', region_name=aws_region,
+                                       aws_access_key_id=storage_options['aws_access_key_id'],
+                                       aws_secret_access_key=storage_options['aws_secret_access_key'],
+                                       aws_session_token=storage_options['aws_session_token'])
+
+            db_uri = lance_db_uri
+            if db_uri != self.db_uri:
+                self.db = None
+            if self.db is None and self.cache is not None and db_uri.startswith('s3://'):
+                try:
+                    # nothing is downloaded up front, blocks are cached as the queries read them
+                    storage_options = {**storage_options, 'aws_endpoint': self.cache.endpoint(self.s3),
+                                       'allow_http': 'true'}
+                except OSError as e:
+                    print(f"Starting the local cache failed, reading from S3: {e}")
+
+            if self.embeddings is None:
+                # must match the model and dimensions the data-pipeline ingested with
+                self.embeddings = TitanEmbeddings(model_id="amazon.titan-embed-text-v2:0", region_name=aws_region)
+
+            if self.db is None:
+                with stage('Connect'):
+                    self.db = await connect_async(
+                        db_uri, storage_options=storage_options if db_uri.startswith('s3://') else None,
+                        read_consistency_interval=TABLE_VERSION_CHECK_INTERVAL)
+                self.db_uri = db_uri
+                with stage('OpenTable'):
+                    self.table = await self.db.open_table(lance_db_table)
+                print('Opened table', lance_db_table, 'from', db_uri)
+        return self
+
+    async def _embed_query(self, query):
+        return await asyncio.to_thread(self.embeddings.embed_query, query)
+
+    async def _vector_search(self, vector, limit, nprobes=None, refine_factor=None):
+        query = self.table.query().nearest_to(vector).limit(limit)
+        if nprobes:
+            query = query.nprobes(nprobes)
+        if refine_factor:
+            query = query.refine_factor(refine_factor)
+        return await query.to_list()
+
+    async def _keyword_search(self, text, limit):
+        try:
+            return await self.table.query().nearest_to_text(text, columns='text').limit(limit).to_list()
+        except Exception as e:
+            # e.g. a table ingested before the full text index was built
+            print(f"Full text search failed, using vector search only: {e}")
+            return []
+
+    async def _search(self, vector, k, nprobes=None, refine_factor=None, text=None):
+        if text is None:
+            rows = await self._vector_search(vector, k, nprobes, refine_factor)
+            scored = [(row, -row['_distance']) for row in rows]
+        else:
+            limit = k * HYBRID_CANDIDATES
+            vector_rows, keyword_rows = await asyncio.gather(
+                self._vector_search(vector, limit, nprobes, refine_factor),
+                self._keyword_search(text, limit),
+            )
+            scored = reciprocal_rank_fusion([keyword_rows, vector_rows], k)
+        # the score orders the documents when the context is packed
+        return [Document(id=row['id'], page_content=row['text'],
+                         metadata={**(row.get('metadata') or {}), 'score': score})
+                for row, score in scored]
+
+    async def embed_query(self, query):
+        """The embedding of `query`, from the query cache for repeated questions."""
+        return await self.query_cache.embed_query(self.embeddings.model_id, query, self._embed_query)
+
+    async def retrieve(self, query, vector, k=RETRIEVAL_K, nprobes=None, refine_factor=None, mode=None):
+        """Documents for a query and its embedding, skipping the searches for repeated questions."""
+        search_options = {'nprobes': nprobes or default_nprobes,
+                          'refine_factor': refine_factor or default_refine_factor}
+        if (mode or default_retrieval_mode) == 'hybrid':
+            search_options['text'] = query
+        # a new table version gets new cache keys, so results from older versions are never served
+        table_version = await self.table.version()
+        return await self.query_cache.retrieve(vector, table_version, k, self._search, **search_options)
+
+    def llm(self, model):
+        model = model or 'anthropic.claude-instant-v1'
+        if model not in self.llms:
+            # https://python.langchain.com/api_reference/aws/chat_models/langchain_aws.chat_models.bedrock_converse.ChatBedrockConverse.html
+            self.llms[model] = ChatBedrockConverse(
+                model=model,
+                region_name=aws_region,
+                max_tokens=2000,
+            )
+        return self.llms[model]
+
+
+# created once per container, reused by every warm invocation
+resources = LambdaResources()
 
-    storage_options = {
-        "aws_region": aws_region,
-        "aws_access_key_id": credentials['AccessKeyId'],
-        "aws_secret_access_key": credentials['SecretAccessKey'],
-        "aws_session_token": credentials['SessionToken']
-    }
+# receives one EMF JSON line per request, stdout ends up in CloudWatch Logs
+telemetry_sink = print
 
-    db = await connect_async(f's3://{lance_db_src}/', storage_options=storage_options)
 
-    # print tables
-    tables = await db.table_names()
-    print('Tables:', tables)
+def write_chunk(response_stream, chunk, streaming_format):
+    if streaming_format == 'fetch-event-source':
+        response_stream.write(f'event: message\n')
+        response_stream.write(f'data: {chunk}')
+        response_stream.write('\n\n')
+    else:
+        response_stream.write(chunk)
 
-    table = await db.open_table(lance_db_table)
+
+async def run_chain(query, model, streaming_format, response_stream, nprobes=None, refine_factor=None,
+                    retrieval_mode=None):
+    telemetry = RequestTelemetry(sink=telemetry_sink)
+    try:
+        return await _run_chain(query, model, streaming_format, response_stream, telemetry,
+                                nprobes, refine_factor, retrieval_mode)
+    except Exception as e:
+        telemetry.set(error=type(e).__name__)
+        raise
+    finally:
+        telemetry.emit()
+
+
+async def _run_chain(query, model, streaming_format, response_stream, telemetry, nprobes, refine_factor,
+                     retrieval_mode):
+    await resources.refresh(telemetry)
 
     print('query', query)
     print('model', model)
     print('streaming_format', streaming_format)
 
-    embeddings = BedrockEmbeddings()
-    vector_store = LanceDB(embedding=embeddings, uri=f's3://{lance_db_src}/', table_name=lance_db_table, connection=db)
-    retriever = vector_store.as_retriever()
+    with telemetry.stage('QueryEmbedding'):
+        vector = await resources.embed_query(query)
+    with telemetry.stage('Search'):
+        docs = await resources.retrieve(query, vector, nprobes=nprobes, refine_factor=refine_factor,
+                                        mode=retrieval_mode)
+
+    llm_model = resources.llm(model)
+    telemetry.set(model=llm_model.model_id, retrievalMode=retrieval_mode or default_retrieval_mode)
+    fingerprint = context_fingerprint(docs)
+    cached = resources.answer_cache.get(llm_model.model_id, fingerprint, vector)
+    telemetry.set(answerCacheHit=cached is not None)
+    if cached is not None:
+        # replay the answer in the same framing as a streamed one
+        for chunk in cached:
+            write_chunk(response_stream, chunk, streaming_format)
+        response_stream.end()
+        print('answer cache hit')
+        return cached
 
     prompt = PromptTemplate.from_template(
         """Answer the following question based only on the following context:
@@ -57,34 +261,27 @@ async def run_chain(query, model, streaming_format, response_stream):
         Question: {question}"""
     )
 
-    # https://python.langchain.com/api_reference/aws/chat_models/langchain_aws.chat_models.bedrock_converse.ChatBedrockConverse.html
-    llm_model = ChatBedrockConverse(
-        model=model or 'anthropic.claude-instant-v1',
-        region_name=aws_region,
-        max_tokens=2000,
-    )
+    with telemetry.stage('PromptBuild'):
+        prompt_value = await prompt.ainvoke({'context': format_documents_as_string(docs), 'question': query})
 
     chain = (
-            retriever.pipe(format_documents_as_string) |
-            (lambda docs: {'context': docs, 'question': query}) |
-            prompt |
             llm_model |
             StrOutputParser()
     )
 
     # https://python.langchain.com/docs/how_to/streaming/
-    stream = chain.astream(query)
+    stream = chain.astream(prompt_value)
+    timer = telemetry.stream()
     chunks = []
     async for chunk in stream:
-        if streaming_format == 'fetch-event-source':
-            chunks.append(chunk)
-            response_stream.write(f'event: message\n')
-            response_stream.write(f'data: {chunk}')
-            response_stream.write('\n\n')
-        else:
-            chunks.append(chunk)
-            response_stream.write(chunk)
+        timer.chunk(estimate_tokens(chunk))
+        chunks.append(chunk)
+        write_chunk(response_stream, chunk, streaming_format)
     response_stream.end()
+    timer.end()
+    # only complete answers are cached
+    resources.answer_cache.put(llm_model.model_id, fingerprint, vector, chunks)
+    print('query cache', json.dumps(resources.query_cache.stats()))
     return chunks
 
 
@@ -97,35 +294,13 @@ def parse_base64(message):
 async def handler(event, response_stream, _context):
     print(json.dumps(event))
     body = parse_base64(event['body']) if event.get('isBase64Encoded') else json.loads(event['body'])
-    chunks = await run_chain(body['query'], body.get('model'), body.get('streamingFormat'), response_stream)
+    chunks = await run_chain(body['query'], body.get('model'), body.get('streamingFormat'), response_stream,
+                             nprobes=body.get('nprobes'), refine_factor=body.get('refineFactor'),
+                             retrieval_mode=body.get('retrievalMode'))
     # not currently doing anything with the chunks[] here.
     print(json.dumps({"status": "complete"}))
 
 
-def assume_limited_role(role_name, region='us-west-2'):
-    """
-        Assume a role with limited permissions to interact with the S3 bucket.
-
-    :return: Temporary credentials for the assumed role.
-    """
-    sts_client = boto3.client('sts', region_name=region)
-    caller_identity = sts_client.get_caller_identity()
-    account_id = caller_identity.get('Account')
-
-    try:
-        assumed_role_object = sts_client.assume_role(
-            RoleArn=f'arn:aws:iam::{account_id}:role/{role_name}',
-            RoleSessionName='LanceDBSession'
-        )
-        credentials = assumed_role_object['Credentials']
-        print("Assumed role and obtained temporary credentials.")
-    except Exception as e:
-        print(f"Error assuming role: {e}")
-        raise
-
-    return credentials
-
-
 # Sample events
 sample_event_1 = {
     "query": "What models are available in Amazon Bedrock?",
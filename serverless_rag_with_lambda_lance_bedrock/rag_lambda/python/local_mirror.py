@@ -0,0 +1,297 @@
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+from botocore.exceptions import ClientError
+
+# the only file of a Lance dataset that is rewritten in place, and possibly with the same size
+LATEST_MANIFEST = "_latest.manifest"
+MB = 1024 * 1024
+# cached blocks of index files and manifests are evicted after those of data files
+HOT_DIRS = ("/_indices/", "/_versions/")
+
+
+def is_manifest(rel_path):
+    """Whether `rel_path`, relative to the dataset directory, is a manifest (written last, read first)."""
+    return rel_path.startswith("_versions/") or rel_path == LATEST_MANIFEST
+
+
+def _is_mutable(key):
+    return key.rsplit("/", 1)[-1] == LATEST_MANIFEST
+
+
+def _tier(key):
+    return "hot" if any(d in "/" + key for d in HOT_DIRS) else "data"
+
+
+class ReadThroughCache:
+    """
+    Read-through cache of S3 objects on local disk (/tmp in Lambda, NVMe on EC2), which LanceDB reads through as
+    a local S3 endpoint (see `endpoint`).
+
+    Lance reads datasets with ranged GETs through its own object store, so the cache sits in front of S3 rather
+    than copying whole datasets: objects are cached in `block_size` blocks keyed by bucket, key, ETag and block
+    number, each fetched on its first read. Lance never modifies a file once written, so a cached block is valid
+    for every version of the dataset; `_latest.manifest`, the one file rewritten in place, and listings always go
+    to S3, so an open table still picks up new versions. Once the blocks take more than `max_bytes` the least
+    recently used are evicted, data blocks before those of index files and manifests, so the hot index partitions
+    of a dataset larger than the disk are still served locally.
+    """
+
+    def __init__(self, cache_dir="/tmp/lance_cache", max_bytes=512 * MB, block_size=MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.s3 = None
+        self.server = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # "bucket/key" -> size, ETag and last modified time of the objects that never change
+        self._objects = {}
+        # tier -> block path -> size, least recently used first
+        self._blocks = {"data": OrderedDict(), "hot": OrderedDict()}
+        self._bytes = 0
+        # blocks left by a previous process, oldest first
+        found = []
+        for tier in self._blocks:
+            for root, _, names in os.walk(os.path.join(cache_dir, tier)):
+                for name in names:
+                    path = os.path.join(root, name)
+                    if name.endswith(".part"):
+                        os.remove(path)
+                    else:
+                        stat = os.stat(path)
+                        found.append((stat.st_mtime, tier, path, stat.st_size))
+        for _, tier, path, size in sorted(found):
+            self._blocks[tier][path] = size
+            self._bytes += size
+        self._evict()
+
+    def endpoint(self, s3):
+        """
+        Start serving the cache on a local port if it isn't yet, reading from S3 with `s3` (pass the new client
+        when the credentials change).
+
+        :return: the endpoint URL, the `aws_endpoint` storage option of the LanceDB connection
+        """
+        self.s3 = s3
+        if self.server is None:
+            self.server = ThreadingHTTPServer(("127.0.0.1", 0), type("Handler", (_Handler,), {"cache": self}))
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def head(self, bucket, key):
+        name = f"{bucket}/{key}"
+        meta = self._objects.get(name)
+        if meta is None:
+            response = self.s3.head_object(Bucket=bucket, Key=key)
+            meta = {"size": response["ContentLength"], "etag": response["ETag"],
+                    "last_modified": response["LastModified"]}
+            # a manifest name is reused when a table is dropped and created again
+            if "/_versions/" not in "/" + key:
+                self._objects[name] = meta
+        return meta
+
+    def _path(self, tier, bucket, key, etag, block):
+        digest = hashlib.sha256(f"{bucket}/{key}\0{etag}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, tier, digest[:2], digest, str(block))
+
+    def _load(self, tier, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if path in self._blocks[tier]:
+                self._blocks[tier].move_to_end(path)
+        return data
+
+    def _store(self, tier, path, data):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.part"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # e.g. a full disk, the block is still served
+            print(f"Caching {path} failed: {e}")
+            return
+        with self._lock:
+            if path not in self._blocks[tier]:
+                self._bytes += len(data)
+            self._blocks[tier][path] = len(data)
+            self._evict()
+
+    def _evict(self):
+        for tier in ("data", "hot"):
+            blocks = self._blocks[tier]
+            while self._bytes > self.max_bytes and blocks:
+                path, size = blocks.popitem(last=False)
+                self._bytes -= size
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def read(self, bucket, key, meta, start, end):
+        """Yield bytes `start` to `end` (inclusive) of an object, fetching the blocks that aren't cached."""
+        tier = _tier(key)
+        first, last = start // self.block_size, end // self.block_size
+        block = first
+        while block <= last:
+            data = self._load(tier, self._path(tier, bucket, key, meta["etag"], block))
+            if data is not None:
+                self.hits += 1
+                blocks = [data]
+            else:
+                # one ranged GET for the run of missing blocks
+                run_end = block
+                while run_end < last and not os.path.exists(
+                        self._path(tier, bucket, key, meta["etag"], run_end + 1)):
+                    run_end += 1
+                self.misses += run_end - block + 1
+                offset = block * self.block_size
+                response = self.s3.get_object(Bucket=bucket, Key=key, IfMatch=meta["etag"], Range=(
+                    f"bytes={offset}-{min((run_end + 1) * self.block_size, meta['size']) - 1}"))
+                body = response["Body"].read()
+                blocks = [body[i:i + self.block_size] for i in range(0, len(body), self.block_size)]
+                for i, data in enumerate(blocks):
+                    self._store(tier, self._path(tier, bucket, key, meta["etag"], block + i), data)
+            for data in blocks:
+                offset = block * self.block_size
+                yield data[max(start - offset, 0):end - offset + 1]
+                block += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """The subset of the S3 API Lance reads a dataset with: HEAD and (ranged) GET of objects, ListObjectsV2."""
+
+    protocol_version = "HTTP/1.1"
+    cache = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _target(self):
+        url = urlsplit(self.path)
+        bucket, _, key = unquote(url.path).lstrip("/").partition("/")
+        return bucket, key, parse_qs(url.query, keep_blank_values=True)
+
+    def do_HEAD(self):
+        self._handle(body=False)
+
+    def do_GET(self):
+        self._handle(body=True)
+
+    def _handle(self, body):
+        bucket, key, query = self._target()
+        try:
+            if not key:
+                self._list(bucket, query)
+            elif _is_mutable(key):
+                self._passthrough(bucket, key, body)
+            else:
+                self._object(bucket, key, body)
+        except ClientError as e:
+            self._error(e.response["ResponseMetadata"]["HTTPStatusCode"], e.response["Error"]["Code"],
+                        str(e), body)
+        except Exception as e:
+            # e.g. S3 can't be reached, the client retries a 503
+            self._error(503, "ServiceUnavailable", str(e), body)
+
+    def _send(self, status, headers, content=b""):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if content:
+            self.wfile.write(content)
+
+    def _error(self, status, code, message, body):
+        content = (f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>{escape(code)}</Code>"
+                   f"<Message>{escape(message)}</Message></Error>").encode("utf-8")
+        self._send(status, {"Content-Type": "application/xml", "Content-Length": len(content)},
+                   content if body else b"")
+
+    def _object(self, bucket, key, body):
+        meta = self.cache.head(bucket, key)
+        size = meta["size"]
+        headers = {"Content-Type": "application/octet-stream", "Accept-Ranges": "bytes", "ETag": meta["etag"],
+                   "Last-Modified": format_datetime(meta["last_modified"], usegmt=True)}
+        start, end, status = 0, size - 1, 200
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            status = 206
+        elif match and match.group(2):
+            start = max(size - int(match.group(2)), 0)
+            status = 206
+        if status == 206:
+            if start >= size or start > end:
+                self._error(416, "InvalidRange", f"bytes {start}-{end} of {size}", body)
+                return
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = end - start + 1
+        self._send(status, headers)
+        if body and size:
+            try:
+                for data in self.cache.read(bucket, key, meta, start, end):
+                    self.wfile.write(data)
+            except Exception as e:
+                # the headers are out, closing the connection tells the client the body is incomplete; a
+                # failed If-Match means the object was replaced, so its size and ETag are looked up again
+                print(f"Reading s3://{bucket}/{key} failed: {e}")
+                self.cache._objects.pop(f"{bucket}/{key}", None)
+                self.close_connection = True
+
+    def _passthrough(self, bucket, key, body):
+        params = {"Bucket": bucket, "Key": key}
+        if self.headers.get("Range"):
+            params["Range"] = self.headers["Range"]
+        response = self.cache.s3.get_object(**params) if body else self.cache.s3.head_object(**params)
+        content = response["Body"].read() if body else b""
+        headers = {"Content-Type": "application/octet-stream", "Content-Length": response["ContentLength"],
+                   "ETag": response["ETag"], "Last-Modified": format_datetime(response["LastModified"], usegmt=True)}
+        if response.get("ContentRange"):
+            headers["Content-Range"] = response["ContentRange"]
+        self._send(206 if response.get("ContentRange") else 200, headers, content)
+
+    def _list(self, bucket, query):
+        params = {"Bucket": bucket}
+        for name, param in (("prefix", "Prefix"), ("delimiter", "Delimiter"), ("start-after", "StartAfter"),
+                            ("continuation-token", "ContinuationToken")):
+            if query.get(name, [""])[0]:
+                params[param] = query[name][0]
+        if query.get("max-keys"):
+            params["MaxKeys"] = int(query["max-keys"][0])
+        response = self.cache.s3.list_objects_v2(**params)
+        parts = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>",
+                 "<ListBucketResult xmlns=\"http://s3.amazonaws.com/doc/2006-03-01/\">",
+                 f"<Name>{escape(bucket)}</Name><Prefix>{escape(params.get('Prefix', ''))}</Prefix>",
+                 f"<KeyCount>{response.get('KeyCount', 0)}</KeyCount>",
+                 f"<MaxKeys>{response.get('MaxKeys', 1000)}</MaxKeys>",
+                 f"<IsTruncated>{str(response.get('IsTruncated', False)).lower()}</IsTruncated>"]
+        if response.get("NextContinuationToken"):
+            parts.append(f"<NextContinuationToken>{escape(response['NextContinuationToken'])}"
+                         f"</NextContinuationToken>")
+        for obj in response.get("Contents", []):
+            last_modified = obj["LastModified"].strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            parts.append(f"<Contents><Key>{escape(obj['Key'])}</Key><LastModified>{last_modified}</LastModified>"
+                         f"<ETag>{escape(obj.get('ETag', ''))}</ETag><Size>{obj['Size']}</Size>"
+                         f"<StorageClass>{obj.get('StorageClass', 'STANDARD')}</StorageClass></Contents>")
+        for prefix in response.get("CommonPrefixes", []):
+            parts.append(f"<CommonPrefixes><Prefix>{escape(prefix['Prefix'])}</Prefix></CommonPrefixes>")
+        parts.append("</ListBucketResult>")
+        content = "".join(parts).encode("utf-8")
+        self._send(200, {"Content-Type": "application/xml", "Content-Length": len(content)}, content)
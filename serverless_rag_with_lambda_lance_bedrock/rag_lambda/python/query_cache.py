@@ -0,0 +1,167 @@
+import hashlib
+import pickle
+import re
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(text):
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip().lower()
+
+
+class TTLCache:
+    """
+    LRU cache whose entries expire `ttl` seconds after they were stored.
+
+    With `path`, entries are also kept in a SQLite file (e.g. on the Lambda's /tmp), which outlives the in-memory
+    tier when the process is restarted and is read through on a memory miss.
+    """
+
+    def __init__(self, max_entries=1024, ttl=900, path=None, table="cache"):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.table = table
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+            self.db.execute(f"DELETE FROM {table} WHERE expires <= ?", (time.time(),))
+            self.db.commit()
+
+    def get(self, key):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] <= now:
+            del self.entries[key]
+            entry = None
+        if entry is None and self.db is not None:
+            row = self.db.execute(f"SELECT value, expires FROM {self.table} WHERE key = ? AND expires > ?",
+                                  (key, now)).fetchone()
+            if row:
+                entry = (pickle.loads(row[0]), row[1])
+                self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        entry = (value, time.time() + self.ttl)
+        self._remember(key, entry)
+        if self.db is not None:
+            self.db.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+                            (key, pickle.dumps(value), entry[1]))
+            # keep the file to the same size as the memory tier, dropping the entries that expire first
+            self.db.execute(f"DELETE FROM {self.table} WHERE key NOT IN "
+                            f"(SELECT key FROM {self.table} ORDER BY expires DESC LIMIT ?)", (self.max_entries,))
+            self.db.commit()
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class QueryCache:
+    """
+    Two level cache in front of the RAG retrieval: normalized query -> embedding, and (embedding, table version)
+    -> retrieved documents. Keying the documents on the table version invalidates them as soon as a new version of
+    the table is published, so a repeated question skips both the Bedrock embedding call and the vector search.
+    """
+
+    def __init__(self, max_entries=1024, ttl=900, path=None):
+        self.embeddings = TTLCache(max_entries, ttl, path, table="embeddings")
+        self.documents = TTLCache(max_entries, ttl, path, table="documents")
+
+    async def embed_query(self, model_id, query, embed):
+        """`embed` is an async function computing the embedding of `query` on a miss."""
+        key = hashlib.sha256(f"{model_id}\0{normalize_query(query)}".encode("utf-8")).hexdigest()
+        vector = self.embeddings.get(key)
+        if vector is None:
+            vector = await embed(query)
+            self.embeddings.put(key, vector)
+        return vector
+
+    async def retrieve(self, vector, table_version, k, search, **search_options):
+        """
+        `search` is an async function running the vector search for `vector` on a miss, called with `k` and
+        `search_options` (e.g. nprobes), which are part of the key.
+        """
+        digest = hashlib.sha256(np.asarray(vector, dtype=np.float32).tobytes()).hexdigest()
+        key = f"{table_version}:{k}:{sorted(search_options.items())}:{digest}"
+        documents = self.documents.get(key)
+        if documents is None:
+            documents = await search(vector, k, **search_options)
+            self.documents.put(key, documents)
+        return documents
+
+    def stats(self):
+        return {"embedding_hits": self.embeddings.hits, "embedding_misses": self.embeddings.misses,
+                "document_hits": self.documents.hits, "document_misses": self.documents.misses}
+
+
+def context_fingerprint(documents):
+    """Identifies the retrieved context by the ids of its documents (chunk ids are hashes of their content)."""
+    ids = [str(doc.id or doc.page_content) for doc in documents]
+    return hashlib.sha256("\0".join(ids).encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    Answers (the streamed chunks) keyed by model id, context fingerprint and query embedding. A question whose
+    embedding has a cosine similarity of at least `threshold` with a cached one, answered by the same model from
+    the same retrieved context, gets the cached answer instead of another LLM call.
+    """
+
+    def __init__(self, max_entries=512, ttl=900, threshold=0.95):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        # (model id, context fingerprint) -> [(unit query vector, chunks, expires)], least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, model_id, fingerprint, vector):
+        key = (model_id, fingerprint)
+        now = time.time()
+        candidates = [entry for entry in self.entries.get(key, []) if entry[2] > now]
+        self.size -= len(self.entries.get(key, [])) - len(candidates)
+        if candidates:
+            self.entries[key] = candidates
+            similarities = np.stack([entry[0] for entry in candidates]) @ self._unit(vector)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return candidates[best][1]
+        elif key in self.entries:
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, model_id, fingerprint, vector, chunks):
+        key = (model_id, fingerprint)
+        self.entries.setdefault(key, []).append((self._unit(vector), list(chunks), time.time() + self.ttl))
+        self.entries.move_to_end(key)
+        self.size += 1
+        while self.size > self.max_entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
@@ -0,0 +1,104 @@
+import re
+
+# the constant from the original RRF paper, it damps the weight of the top few ranks
+RRF_K = 60
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def reciprocal_rank_fusion(result_lists, limit, k=RRF_K, key='id'):
+    """
+    Fuse ranked lists of rows (e.g. keyword and vector search results) by reciprocal rank: a row scores
+    sum(1 / (k + rank)) over the lists it appears in, so rows ranked well by both searches come first.
+
+    :return: up to `limit` (row, score) pairs, best first
+    """
+    rows, scores = {}, {}
+    for results in result_lists:
+        for rank, row in enumerate(results, start=1):
+            rows.setdefault(row[key], row)
+            scores[row[key]] = scores.get(row[key], 0.0) + 1.0 / (k + rank)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [(rows[row_id], scores[row_id]) for row_id in ranked]
+
+
+def estimate_tokens(text):
+    """
+    A fast local estimate of the number of LLM tokens in `text`: about four characters per token for English
+    prose, or one per word or punctuation mark when that's more (code, identifiers, numbers).
+    """
+    return max(len(text) // 4, len(_TOKEN_PATTERN.findall(text)))
+
+
+def _overlap(a, b, min_overlap, max_overlap):
+    """Length of the longest suffix of `a` that is a prefix of `b`, 0 if shorter than `min_overlap`."""
+    for size in range(min(len(a), len(b), max_overlap), min_overlap - 1, -1):
+        if a.endswith(b[:size]):
+            return size
+    return 0
+
+
+def _merge(a, b, min_overlap, max_overlap):
+    """`a` and `b` as one text if one contains the other or they overlap, else None."""
+    if b in a:
+        return a
+    if a in b:
+        return b
+    size = _overlap(a, b, min_overlap, max_overlap)
+    if size:
+        return a + b[size:]
+    size = _overlap(b, a, min_overlap, max_overlap)
+    if size:
+        return b + a[size:]
+    return None
+
+
+def pack_context(documents, token_budget, min_overlap=20, max_overlap=400):
+    """
+    Assemble retrieved chunks into as little prompt context as possible.
+
+    Chunks from the same page that repeat or overlap each other (the text splitter overlaps consecutive chunks)
+    are merged into one passage, which scores as its best chunk. Passages are then taken best score first
+    (`metadata["score"]`, else retrieval order) while they fit in `token_budget`; the best passage is always
+    included, truncated to the budget if it doesn't fit on its own.
+
+    :return: the passages as Documents, best first
+    """
+    passages = []
+    for rank, doc in enumerate(documents):
+        score = doc.metadata.get('score', -rank)
+        page = (doc.metadata.get('source'), doc.metadata.get('page'))
+        passages.append({'page': page, 'text': doc.page_content, 'score': score, 'doc': doc})
+
+    merged = True
+    while merged:
+        merged = False
+        for i, a in enumerate(passages):
+            for b in passages[i + 1:]:
+                if a['page'] != b['page']:
+                    continue
+                text = _merge(a['text'], b['text'], min_overlap, max_overlap)
+                if text is not None:
+                    a['text'], a['score'] = text, max(a['score'], b['score'])
+                    passages.remove(b)
+                    merged = True
+                    break
+            if merged:
+                break
+
+    packed, used = [], 0
+    for passage in sorted(passages, key=lambda passage: passage['score'], reverse=True):
+        text = passage['text']
+        tokens = estimate_tokens(text)
+        if used + tokens > token_budget:
+            if packed:
+                continue
+            # never answer without context: cut the best passage down to the budget
+            while text and estimate_tokens(text) > token_budget:
+                text = text[:min(len(text) - 1, len(text) * token_budget // estimate_tokens(text))]
+            print(f"Truncated the best passage from {tokens} to {estimate_tokens(text)} tokens to fit the context.")
+            tokens = estimate_tokens(text)
+        used += tokens
+        doc = passage['doc']
+        packed.append(doc.model_copy(update={'page_content': text}))
+    return packed
@@ -0,0 +1,86 @@
+import json
+import time
+from contextlib import contextmanager
+
+NAMESPACE = "StreamingRag"
+
+# the first request of a container pays for imports, STS and connecting; later (warm) ones shouldn't
+_cold_start = True
+
+
+class RequestTelemetry:
+    """
+    Timings of one request, written as a CloudWatch Embedded Metric Format (EMF) JSON line by `emit`.
+
+    Lambda sends stdout to CloudWatch Logs, which turns EMF lines into metrics without any API calls, so the
+    default `sink` is print. Tests pass a sink that collects the records to assert on them.
+    """
+
+    def __init__(self, sink=print, namespace=NAMESPACE):
+        global _cold_start
+        self.sink = sink
+        self.namespace = namespace
+        self.cold_start, _cold_start = _cold_start, False
+        self.started = time.perf_counter()
+        self.metrics = {}
+        self.properties = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Record the duration of the block as `<name>Ms`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(f"{name}Ms", (time.perf_counter() - start) * 1000)
+
+    def record(self, name, value, unit="Milliseconds"):
+        self.metrics[name] = (value, unit)
+
+    def set(self, **properties):
+        """Context (not metrics) for the record, e.g. the model id or cache hits."""
+        self.properties.update(properties)
+
+    def stream(self):
+        return StreamTimer(self)
+
+    def emit(self):
+        self.record("TotalMs", (time.perf_counter() - self.started) * 1000)
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [["ColdStart"]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in self.metrics.items()],
+                }],
+            },
+            "ColdStart": str(self.cold_start).lower(),
+            **self.properties,
+            **{name: round(value, 3) for name, (value, _) in self.metrics.items()},
+        }
+        self.sink(json.dumps(record))
+        return record
+
+
+class StreamTimer:
+    """Time to first token, tokens per second and duration of a streamed LLM response."""
+
+    def __init__(self, telemetry):
+        self.telemetry = telemetry
+        self.started = time.perf_counter()
+        self.first = None
+        self.tokens = 0
+
+    def chunk(self, tokens):
+        if self.first is None:
+            self.first = time.perf_counter()
+            self.telemetry.record("TimeToFirstTokenMs", (self.first - self.started) * 1000)
+        self.tokens += tokens
+
+    def end(self):
+        now = time.perf_counter()
+        self.telemetry.record("StreamMs", (now - self.started) * 1000)
+        self.telemetry.record("OutputTokens", self.tokens, unit="Count")
+        if self.first is not None and now > self.first:
+            self.telemetry.record("TokensPerSecond", self.tokens / (now - self.first), unit="Count/Second")
@@ -58,6 +58,48 @@ async def test_handler():
     print("Final Output:\n\n", output)
 
 
+class MockTelemetrySink:
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, line):
+        self.records.append(json.loads(line))
+
+
+async def test_handler_telemetry(tmp_path, monkeypatch):
+    """Runs offline against a local dataset with the stand-ins for STS and Bedrock from bench_handler.py."""
+    import index
+    import telemetry
+    from bench_handler import StubChatModel, StubCredentials, StubEmbeddings, build_dataset
+
+    embeddings = StubEmbeddings(dimensions=32, latency=0)
+    build_dataset(str(tmp_path), 50, embeddings, index.lance_db_table)
+    resources = index.LambdaResources()
+    resources.credentials = StubCredentials()
+    resources.embeddings = embeddings
+    resources.llms["stub-chat"] = StubChatModel(first_token_latency=0.01, token_latency=0.001, tokens=10)
+    sink = MockTelemetrySink()
+    monkeypatch.setattr(index, "resources", resources)
+    monkeypatch.setattr(index, "lance_db_uri", str(tmp_path))
+    monkeypatch.setattr(index, "telemetry_sink", sink)
+    monkeypatch.setattr(telemetry, "_cold_start", True)
+
+    event = {"body": json.dumps({"query": f"telemetry {tmp_path.name}: what does the cache store?",
+                                 "model": "stub-chat", "streamingFormat": None}), "isBase64Encoded": False}
+    await handler(event, MockResponseStream(), None)
+
+    assert len(sink.records) == 1
+    record = sink.records[0]
+    metrics = {metric["Name"] for metric in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]}
+    for name in ("CredentialsMs", "ConnectMs", "OpenTableMs", "QueryEmbeddingMs", "SearchMs", "PromptBuildMs",
+                 "TimeToFirstTokenMs", "StreamMs", "TotalMs", "OutputTokens", "TokensPerSecond"):
+        assert name in metrics and record[name] >= 0
+    assert record["ColdStart"] == "true"
+    assert record["answerCacheHit"] is False
+    assert record["OutputTokens"] > 0
+    assert record["TimeToFirstTokenMs"] <= record["StreamMs"] <= record["TotalMs"]
+
+
 @pytest.mark.asyncio
 async def main():
     await test_handler()
@@ -0,0 +1,111 @@
+import io
+import os
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+
+import pytest
+from botocore.exceptions import ClientError
+
+from local_mirror import ReadThroughCache
+
+
+class FakeS3:
+    """In-memory stand-in for the S3 client calls the cache makes, counting the object reads."""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.gets = []
+
+    def _object(self, key, operation):
+        if key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": key},
+                               "ResponseMetadata": {"HTTPStatusCode": 404}}, operation)
+        data = self.objects[key]
+        return data, {"ETag": f'"{len(data)}-{data[:4].hex()}"',
+                      "LastModified": datetime(2025, 1, 1, tzinfo=timezone.utc)}
+
+    def head_object(self, Bucket, Key, Range=None):
+        data, meta = self._object(Key, "HeadObject")
+        return {"ContentLength": len(data), **meta}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        data, meta = self._object(Key, "GetObject")
+        self.gets.append((Key, Range))
+        response = {"ContentLength": len(data), **meta}
+        if Range:
+            start, end = (int(value) for value in Range[len("bytes="):].split("-"))
+            end = min(end, len(data) - 1)
+            response.update(ContentLength=end - start + 1, ContentRange=f"bytes {start}-{end}/{len(data)}")
+            data = data[start:end + 1]
+        return {**response, "Body": io.BytesIO(data)}
+
+    def list_objects_v2(self, Bucket, Prefix="", **kwargs):
+        meta = {"LastModified": datetime(2025, 1, 1, tzinfo=timezone.utc)}
+        contents = [{"Key": key, "Size": len(data), **meta} for key, data in sorted(self.objects.items())
+                    if key.startswith(Prefix)]
+        return {"Contents": contents, "KeyCount": len(contents), "IsTruncated": False}
+
+
+def get(url, byte_range=None):
+    request = urllib.request.Request(url, headers={"Range": byte_range} if byte_range else {})
+    with urllib.request.urlopen(request) as response:
+        return response.status, response.read()
+
+
+@pytest.fixture
+def objects():
+    return {
+        "t.lance/data/a.lance": os.urandom(10_000),
+        "t.lance/_indices/i/index.idx": os.urandom(3_000),
+        "t.lance/_latest.manifest": b"version 1",
+    }
+
+
+def test_ranged_reads_are_cached(tmp_path, objects):
+    s3 = FakeS3(objects)
+    cache = ReadThroughCache(str(tmp_path), max_bytes=1 << 20, block_size=1024)
+    url = cache.endpoint(s3) + "/bucket/t.lance/data/a.lance"
+
+    assert get(url, "bytes=1000-4999") == (206, objects["t.lance/data/a.lance"][1000:5000])
+    assert len(s3.gets) == 1
+    # covered by the blocks read above
+    assert get(url, "bytes=2000-3000") == (206, objects["t.lance/data/a.lance"][2000:3001])
+    assert len(s3.gets) == 1
+    assert get(url) == (200, objects["t.lance/data/a.lance"])
+    assert get(url, "bytes=-10") == (206, objects["t.lance/data/a.lance"][-10:])
+
+    # blocks on disk are used by the next process too
+    s3.gets.clear()
+    cache = ReadThroughCache(str(tmp_path), max_bytes=1 << 20, block_size=1024)
+    assert get(cache.endpoint(s3) + "/bucket/t.lance/data/a.lance") == (200, objects["t.lance/data/a.lance"])
+    assert s3.gets == []
+
+
+def test_latest_manifest_and_listings_go_to_s3(tmp_path, objects):
+    s3 = FakeS3(objects)
+    endpoint = ReadThroughCache(str(tmp_path), block_size=1024).endpoint(s3)
+
+    assert get(endpoint + "/bucket/t.lance/_latest.manifest") == (200, b"version 1")
+    objects["t.lance/_latest.manifest"] = b"version 2"
+    assert get(endpoint + "/bucket/t.lance/_latest.manifest") == (200, b"version 2")
+
+    status, content = get(endpoint + "/bucket?list-type=2&prefix=t.lance/_indices/")
+    assert status == 200 and b"<Key>t.lance/_indices/i/index.idx</Key><LastModified>" in content
+    with pytest.raises(urllib.error.HTTPError) as error:
+        get(endpoint + "/bucket/t.lance/data/missing.lance")
+    assert error.value.code == 404
+
+
+def test_eviction_keeps_index_blocks(tmp_path, objects):
+    s3 = FakeS3(objects)
+    cache = ReadThroughCache(str(tmp_path), max_bytes=4096, block_size=1024)
+    endpoint = cache.endpoint(s3)
+
+    get(endpoint + "/bucket/t.lance/_indices/i/index.idx")
+    get(endpoint + "/bucket/t.lance/data/a.lance")
+    assert sum(cache._blocks["hot"].values()) == 3_000
+    assert cache._bytes <= 4096
+    s3.gets.clear()
+    assert get(endpoint + "/bucket/t.lance/_indices/i/index.idx")[1] == objects["t.lance/_indices/i/index.idx"]
+    assert s3.gets == []
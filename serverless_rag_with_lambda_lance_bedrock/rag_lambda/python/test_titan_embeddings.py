@@ -0,0 +1,67 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from titan_embeddings import TitanEmbeddings
+
+THROTTLED_REQUESTS = 3
+
+
+class BedrockRuntimeHandler(BaseHTTPRequestHandler):
+    """Stub of bedrock-runtime InvokeModel that throttles the first THROTTLED_REQUESTS requests."""
+
+    lock = threading.Lock()
+    requests = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.lock:
+            type(self).requests += 1
+            throttled = type(self).requests <= THROTTLED_REQUESTS
+        if throttled:
+            self._send(429, {"message": "Too many requests, please wait before trying again."},
+                       error_type="ThrottlingException")
+        else:
+            self._send(200, {"embedding": [float(len(body["inputText"]))] * body["dimensions"],
+                             "inputTextTokenCount": len(body["inputText"].split())})
+
+    def _send(self, status, payload, error_type=None):
+        content = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        if error_type:
+            self.send_header("x-amzn-ErrorType", error_type)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def endpoint_url(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "stub")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "stub")
+    BedrockRuntimeHandler.requests = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BedrockRuntimeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_embed_array_retries_throttled_requests(endpoint_url):
+    embeddings = TitanEmbeddings(region_name="us-west-2", dimensions=16, endpoint_url=endpoint_url)
+    texts = ["a", "bb", "ccc", "dddd", "eeeee"]
+
+    vectors = embeddings.embed_array(texts)
+
+    assert vectors.dtype == np.float32 and vectors.shape == (len(texts), 16)
+    assert vectors[:, 0].tolist() == [float(len(text)) for text in texts]
+    assert BedrockRuntimeHandler.requests == len(texts) + THROTTLED_REQUESTS
+    assert embeddings.limiter.limit < 8
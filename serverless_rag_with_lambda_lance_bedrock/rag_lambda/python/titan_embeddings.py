@@ -0,0 +1,104 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import boto3
+import numpy as np
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from langchain_core.embeddings import Embeddings
+
+THROTTLING_ERRORS = {"ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException",
+                     "ModelNotReadyException"}
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit that grows by one per window of successful requests (additive increase) and halves on
+    throttling (multiplicative decrease), like TCP congestion control.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class TitanEmbeddings(Embeddings):
+    """
+    Amazon Titan text embeddings with many `invoke_model` calls in flight over one pooled client.
+
+    Concurrency adapts to Bedrock throttling (see `AIMDLimiter`) and throttled requests are retried with backoff.
+    `endpoint_url` points the client at a stub of bedrock-runtime for testing.
+    """
+
+    def __init__(self, model_id="amazon.titan-embed-text-v2:0", region_name=None, dimensions=1024, normalize=True,
+                 max_concurrency=64, initial_concurrency=8, max_retries=8, endpoint_url=None, client=None):
+        self.model_id = model_id
+        # v1 doesn't take options and always returns 1536 dimensions
+        self.is_v2 = "v2" in model_id
+        self.dimensions = dimensions if self.is_v2 else None
+        self.normalize = normalize
+        self.max_retries = max_retries
+        self.limiter = AIMDLimiter(initial_concurrency, maximum=max_concurrency)
+        # one connection per concurrent request, throttling is retried here rather than by botocore
+        config = Config(max_pool_connections=max_concurrency, retries={"max_attempts": 1, "mode": "standard"})
+        self.client = client or boto3.client("bedrock-runtime", region_name=region_name, endpoint_url=endpoint_url,
+                                             config=config)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def _body(self, text):
+        body = {"inputText": text}
+        if self.is_v2:
+            body.update(dimensions=self.dimensions, normalize=self.normalize)
+        return json.dumps(body)
+
+    def _invoke(self, text):
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            throttled = False
+            try:
+                response = self.client.invoke_model(modelId=self.model_id, body=self._body(text),
+                                                    accept="application/json", contentType="application/json")
+                return json.loads(response["body"].read())["embedding"]
+            except ClientError as e:
+                # before re-raising, so the limiter also backs off after the last throttled attempt
+                throttled = e.response["Error"]["Code"] in THROTTLING_ERRORS
+                if not throttled or attempt == self.max_retries:
+                    raise
+            finally:
+                self.limiter.release(throttled)
+            delay = min(20.0, 0.1 * 2 ** attempt)
+            time.sleep(random.uniform(delay / 2, delay))
+
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        """Embed `texts` concurrently into a (len(texts), dimensions) float32 array."""
+        if not texts:
+            return np.empty((0, self.dimensions or 0), dtype=np.float32)
+        return np.asarray(list(self.executor.map(self._invoke, texts)), dtype=np.float32)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_array([text])[0].tolist()